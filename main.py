@@ -1,96 +1,2320 @@
 # Importing required libraries
 import argparse
+import atexit
+import bz2
+import codecs
+import cProfile
+import concurrent.futures
+import fnmatch
+import functools
+import gzip
+import io
+import itertools
+import json
+import locale
+import lzma
+import mmap
 import os
+import platform
+import random
 import re
+import select
+import signal
+import socket
+import socketserver
+import sqlite3
+import stat
+import struct
 import sys
-import codecs
+import tempfile
+import threading
+import time
+import typing
+from collections import deque
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the benchmark reports no peak memory use there
+    resource = None
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    # Python before 3.11
+    import sre_constants
+    import sre_parse
+
+try:
+    import ctypes
+except ImportError:
+    # without it followed files are polled instead of watched with inotify
+    ctypes = None
+
+# number of bytes read from a file at once, lines are handed to the matcher as soon as they are read
+READ_CHUNK_SIZE = 64 * 1024
+
+# number of bytes of output collected before they are written at once
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# number of files handed to a worker process at once in a parallel recursive search
+RECURSIVE_CHUNK_SIZE = 16
+
+# number of bytes at the start of a file that are checked to tell binary files from text files
+BINARY_CHECK_SIZE = 8 * 1024
+
+# number of patterns quoted in a message, the others are only counted
+QUOTED_PATTERNS = 5
+
+# name of the trigram index file in an indexed directory
+INDEX_FILE_NAME = '.grepindex'
+
+# the index file and the files SQLite keeps next to it, they are never searched
+INDEX_FILE_NAMES = frozenset(INDEX_FILE_NAME + suffix for suffix in ('', '-journal', '-wal', '-shm'))
+
+# magic bytes at the start of a compressed file and the module that decompresses it
+COMPRESSION_FORMATS = ((b'\x1f\x8b', gzip), (b'BZh', bz2), (b'\xfd7zXZ\x00', lzma))
+
+# errors of a corrupt compressed file that are not an OSError
+DECOMPRESSION_ERRORS = (EOFError, lzma.LZMAError)
+
+# files larger than this are not indexed and always searched
+INDEX_MAX_FILESIZE = 32 * 1024 * 1024
+
+# what a recursive search does with binary files: report that they match, skip them or search them as text
+BINARY_FILES_POLICIES = ('binary', 'without-match', 'text')
+
+# line output between two groups of lines around matches that are not adjacent
+GROUP_SEPARATOR = '--'
+
+# which files are listed instead of the matching lines: the files that match or the files that do not
+LIST_FILES_MODES = ('with-match', 'without-match')
+
+# exit status when a line is selected, when nothing is selected and when an error occurred
+EXIT_MATCH, EXIT_NO_MATCH, EXIT_ERROR = 0, 1, 2
+
+# exit status of a search that is interrupted by Ctrl-C, 128 + SIGINT like a shell reports it
+EXIT_INTERRUPTED = 130
+
+
+# how bytes that are not valid in the encoding of the input are decoded, they never stop the search
+DECODE_ERRORS = 'replace'
+
+# corpora the benchmark generates: one large file, many small files and small files in a deep directory tree
+BENCH_CORPORA = ('large-file', 'small-files', 'deep-tree')
+
+# share of the lines of a benchmark corpus that match the benchmark patterns
+BENCH_MATCH_RATES = {'sparse': 0.001, 'dense': 0.2}
+
+# functions the benchmark times
+BENCH_TARGETS = ('search_pattern_in_strings', 'my_grep', 'search_files_recursive')
+
+# patterns the benchmark searches for: name -> (pattern, case-insensitive, lines before and after every match)
+BENCH_PATTERNS = {
+    'literal': ('needle', False, 0),
+    'case-insensitive': ('NEEDLE', True, 0),
+    'regex': (r'needle-\d+', False, 0),
+    'context': ('needle', False, 2),
+}
+
+# words the lines of a benchmark corpus are made of, none of them matches a benchmark pattern
+BENCH_WORDS = ('request', 'handled', 'user', 'session', 'started', 'timeout', 'cache', 'miss', 'hit', 'worker',
+               'queue', 'retry', 'GET', 'POST', '/api/v1/items', 'status=200', 'status=500', 'latency_ms=12',
+               'INFO', 'WARN', 'DEBUG', 'connection', 'closed', 'opened', 'payload', 'bytes=512')
+
+# size of a file of the small-files and deep-tree corpora and number of levels of the deep tree
+BENCH_SMALL_FILE_SIZE = 4 * 1024
+BENCH_TREE_DEPTH = 8
+
+# seconds --follow waits before it polls the files again, doubled up to FOLLOW_MAX_INTERVAL while nothing changes;
+# with inotify FOLLOW_MAX_INTERVAL is how long it waits for a change before it checks every file anyway
+FOLLOW_MIN_INTERVAL = 0.1
+FOLLOW_MAX_INTERVAL = 2.0
+
+# inotify events of a watched directory that can change a followed file in it
+INOTIFY_EVENTS = (0x002  # IN_MODIFY
+                  | 0x004  # IN_ATTRIB
+                  | 0x040  # IN_MOVED_FROM
+                  | 0x080  # IN_MOVED_TO
+                  | 0x100  # IN_CREATE
+                  | 0x200)  # IN_DELETE
+
+# number of compiled patterns the library API and the search server keep for repeated queries
+PATTERN_CACHE_SIZE = 256
+
+# characters with a special meaning in a regular expression
+REGEX_SPECIAL_CHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+# global inline flags at the start of a pattern, e.g. '(?i)'
+GLOBAL_FLAGS_REGEX = re.compile(r'\(\?([aiLmsux]+)\)')
+
+# parser opcodes of the references of a pattern to its own groups, a backreference or a conditional
+GROUP_REFERENCE_OPCODES = frozenset(getattr(sre_constants, name) for name in
+                                    ('GROUPREF', 'GROUPREF_EXISTS', 'GROUPREF_IGNORE', 'GROUPREF_LOC_IGNORE',
+                                     'GROUPREF_UNI_IGNORE') if hasattr(sre_constants, name))
+
+
+def _literal_text(search_pattern: str):
+    """
+    Return the plain text a pattern matches when it has no regular expression syntax, escaped punctuation like `\\.`
+    counts as plain text.
+
+    :param search_pattern: pattern to check
+    :return: the literal text of the pattern or None if it needs the regular expression engine
+    """
+    text = []
+    escaped = False
+    for char in search_pattern:
+        if escaped:
+            if char.isalnum():
+                # escapes like \d or \b are character classes and assertions
+                return None
+            text.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in REGEX_SPECIAL_CHARACTERS:
+            return None
+        else:
+            text.append(char)
+    if escaped:
+        return None
+    return ''.join(text)
+
+
+def _is_byte_safe(search_pattern: str, literal, case_insensitive: bool) -> bool:
+    """
+    Check if a pattern finds exactly the same lines in UTF-8 encoded bytes as in the decoded text.
+
+    :param search_pattern: pattern to check
+    :param literal: the literal text of the pattern, None if it is a regular expression
+    :param case_insensitive: flag for case-insensitive search
+    :return: True if the pattern can be searched in raw bytes
+    """
+    if '\n' in search_pattern or '\r' in search_pattern:
+        return False
+    if literal is not None and not case_insensitive:
+        # UTF-8 is self-synchronizing, a substring of the text is a substring of the bytes
+        return True
+    if not search_pattern.isascii():
+        return False
+    if case_insensitive and set(search_pattern.lower()) & set('iks'):
+        # these letters also match non-ASCII letters case-insensitively, e.g. 'k' matches the Kelvin sign
+        return False
+    if literal is None and any(token in search_pattern for token in ('.', '\\', '[', '(?')):
+        # character classes, escapes and extensions behave differently on bytes or can match a line break
+        return False
+    return True
+
+
+def _trie_regex(words) -> str:
+    """
+    Build a regular expression matching any of a list of words from a trie of the words, e.g. 'ab(?:c|d)' for 'abc'
+    and 'abd'. The branches of every trie node start with different characters, so the regular expression engine
+    follows a single path at each position of the text whatever the number of words.
+
+    :param words: list of plain text words
+    :return: regular expression source
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # end of a word
+
+    def node_regex(node: dict) -> str:
+        branches = [re.escape(char) + node_regex(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        regex = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            # a word ends here, the longer words are optional
+            regex = '(?:' + regex + ')?'
+        return regex
+
+    regex = node_regex(trie)
+    # the empty word matches everywhere
+    return regex if regex or '' not in trie else ''
+
+
+def _has_group_references(search_pattern: str) -> bool:
+    """
+    Check if a pattern refers to its own groups by number or name, e.g. '(a)\\1' or '(?(1)a|b)'. Such a pattern can
+    not be combined with other patterns, the numbers of its groups would change.
+
+    :param search_pattern: valid regular expression to check
+    :return: True if the pattern has a backreference or a conditional
+    """
+    pending = [sre_parse.parse(search_pattern)]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, sre_parse.SubPattern):
+            for opcode, argument in value.data:
+                if opcode in GROUP_REFERENCE_OPCODES:
+                    return True
+                pending.append(argument)
+        elif isinstance(value, (tuple, list)):
+            # the arguments of groups, branches, repeats and assertions hold their subpatterns
+            pending.extend(value)
+    return False
+
+
+def _scoped_flags(search_pattern: str) -> str:
+    """
+    Turn the global inline flags at the start of a pattern into flags of a group around it, e.g. '(?i)abc' into
+    '(?i:abc)', so the flags only apply to this pattern when it is combined with others.
+
+    :param search_pattern: pattern to convert
+    :return: the pattern with scoped flags, or the pattern itself if it has no global flags
+    """
+    flags = ''
+    position = 0
+    match = GLOBAL_FLAGS_REGEX.match(search_pattern)
+    while match is not None:
+        flags += match.group(1)
+        position = match.end()
+        match = GLOBAL_FLAGS_REGEX.match(search_pattern, position)
+    if not flags:
+        return search_pattern
+    # a verbose comment at the end of the pattern would hide the closing parenthesis
+    end = '\n)' if 'x' in flags else ')'
+    return f"(?{''.join(dict.fromkeys(flags))}:{search_pattern[position:]}{end}"
+
+
+class _RegexSet:
+    """
+    Regular expressions searched as one, for patterns that can not be combined into a single regular expression.
+
+    A search returns the leftmost match of any of them, the first one wins a tie. The next match of every regular
+    expression is remembered per thread, so searching a buffer from match to match reads it once for every regular
+    expression instead of once for every match.
+    """
+
+    def __init__(self, regexes: list):
+        """
+        :param regexes: compiled regular expressions, all of str or all of bytes
+        """
+        self.regexes = regexes
+        self._next = threading.local()
+
+    def search_any(self, string, pos: int = 0, endpos: int = sys.maxsize) -> tuple:
+        """
+        Find the leftmost match of any of the regular expressions.
+
+        :param string: text or bytes to search
+        :param pos: position to start the search at
+        :param endpos: position to end the search at
+        :return: tuple with the index of the regular expression and the match, or (None, None) if nothing matches
+        """
+        cache = self._next
+        if getattr(cache, 'string', None) is not string or cache.endpos != endpos:
+            # (position the search started at, match found) of every regular expression
+            cache.string, cache.endpos, cache.found = string, endpos, [None] * len(self.regexes)
+        found = cache.found
+        best_index, best_match = None, None
+        for index, regex in enumerate(self.regexes):
+            known = found[index]
+            # a match found from an earlier position is still the leftmost one if it starts after pos
+            if known is None or known[0] > pos or known[1] is not None and known[1].start() < pos:
+                known = found[index] = pos, regex.search(string, pos, endpos)
+            match = known[1]
+            if match is not None and (best_match is None or match.start() < best_match.start()):
+                best_index, best_match = index, match
+        return best_index, best_match
+
+    def search(self, string, pos: int = 0, endpos: int = sys.maxsize):
+        return self.search_any(string, pos, endpos)[1]
+
+    def finditer(self, string, pos: int = 0, endpos: int = sys.maxsize):
+        end = min(endpos, len(string))
+        while pos <= end:
+            match = self.search(string, pos, endpos)
+            if match is None:
+                return
+            yield match
+            pos = match.end() if match.end() > match.start() else match.end() + 1
+
+
+def _compile_sources(sources: list, flags: int):
+    # a single regular expression, or a set of them when some patterns could not be combined
+    regexes = [re.compile(source, flags) for source in sources]
+    return regexes[0] if len(regexes) == 1 else _RegexSet(regexes)
+
+
+class CompiledPattern:
+    """
+    Search pattern compiled once per search and shared by every file that is searched.
+
+    Pure literal patterns are matched with a substring search, everything else keeps the full regular expression
+    semantics of `re.search`. A list of patterns is compiled into a single regular expression, its literal patterns
+    into one trie of all of them, so every line is scanned once whatever the number of patterns. Patterns that refer
+    to their own groups keep regular expressions of their own, the group numbers would change in the combined one.
+    """
+
+    def __init__(self, search_pattern, case_insensitive: bool = False):
+        """
+        :param search_pattern: pattern to search for or list of patterns, a line matches if any of them matches
+        :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+        """
+        self.patterns = [search_pattern] if isinstance(search_pattern, str) else list(search_pattern)
+        if not self.patterns:
+            raise ValueError("No pattern to search for.")
+        self.pattern = self.patterns[0] if len(self.patterns) == 1 else None
+        self.case_insensitive = case_insensitive
+        flags = re.IGNORECASE if case_insensitive else 0
+        literals = [_literal_text(pattern) for pattern in self.patterns]
+        self.literal = literals[0] if len(self.patterns) == 1 else None
+
+        # patterns searched with regular expressions of their own after the combined one
+        self._separate_patterns = []
+        if self.pattern is not None:
+            sources = [self.pattern]
+            bytes_sources = [re.escape(self.literal) if self.literal is not None else self.pattern]
+        else:
+            # literal text matched by the trie -> pattern, to tell which pattern matched
+            self._literal_patterns = {}
+            words = []
+            for pattern, literal in zip(self.patterns, literals):
+                if literal is not None:
+                    word = literal.lower() if case_insensitive and literal.isascii() else literal
+                    if word not in self._literal_patterns:
+                        self._literal_patterns[word] = pattern
+                        words.append(word)
+            groups = []
+            group_names = {'literals'}
+            for index, (pattern, literal) in enumerate(zip(self.patterns, literals)):
+                if literal is not None:
+                    continue
+                # every pattern is checked on its own, so an error points at the pattern that has it
+                names = re.compile(pattern, flags).groupindex.keys()
+                if _has_group_references(pattern) or group_names.intersection(names) \
+                        or any(re.fullmatch(r'p\d+', name) for name in names):
+                    self._separate_patterns.append(pattern)
+                else:
+                    group_names.update(names)
+                    groups.append(f"(?P<p{index}>{_scoped_flags(pattern)})")
+            if words:
+                groups.append(f"(?P<literals>{_trie_regex(words)})")
+            sources = (['|'.join(groups)] if groups else []) + self._separate_patterns
+            bytes_sources = sources
+        self.regex = _compile_sources(sources, flags)
+
+        # the same pattern for UTF-8 encoded bytes, None when it would not find the same lines as the text pattern
+        self.bytes_regex = None
+        if all(_is_byte_safe(pattern, literal, case_insensitive) for pattern, literal in zip(self.patterns, literals)):
+            self.bytes_regex = _compile_sources([source.encode('utf-8') for source in bytes_sources],
+                                                re.MULTILINE | flags)
+        # pattern to look for a match in binary files without decoding them, it may differ from the text pattern
+        # for non-ASCII bytes
+        self.binary_regex = self.bytes_regex
+        if self.binary_regex is None:
+            try:
+                self.binary_regex = _compile_sources([source.encode('utf-8') for source in sources],
+                                                     re.MULTILINE | flags)
+            except re.error:
+                pass
+
+        if self.literal is None:
+            self.search = self.regex.search
+        elif not case_insensitive:
+            self.search = self._search_literal
+        elif self.literal.isascii():
+            self._folded_literal = self.literal.lower()
+            self.search = self._search_folded_literal
+        else:
+            # case folding of non-ASCII text is left to the regular expression engine
+            self.search = self.regex.search
+
+    def bytes_regex_for(self, encoding: str):
+        """
+        Get the bytes version of the pattern for input in an encoding.
+
+        :param encoding: encoding of the input
+        :return: the compiled bytes pattern or None if the input has to be decoded to be searched
+        """
+        if self.bytes_regex is None:
+            return None
+        if _is_utf8(encoding):
+            return self.bytes_regex
+        if all(pattern.isascii() for pattern in self.patterns) and _is_single_byte(encoding):
+            # ASCII text is the same bytes in UTF-8 and in ASCII compatible single-byte encodings
+            return self.bytes_regex
+        return None
+
+    def _search_literal(self, line: str) -> bool:
+        return self.literal in line
+
+    def _search_folded_literal(self, line: str) -> bool:
+        # lower() and re.IGNORECASE only agree on ASCII text, e.g. the Kelvin sign matches 'k' case-insensitively
+        if line.isascii():
+            return self._folded_literal in line.lower()
+        return self.regex.search(line) is not None
+
+    def matched_pattern(self, line: str):
+        """
+        Tell which pattern matches a line.
+
+        :param line: line to check
+        :return: the pattern with the leftmost match in the line or None if no pattern matches
+        """
+        if isinstance(self.regex, _RegexSet):
+            index, match = self.regex.search_any(line)
+        else:
+            index, match = 0, self.regex.search(line)
+        if match is None:
+            return None
+        if self.pattern is not None:
+            return self.pattern
+        # the combined regular expression, if any, comes before the ones of the separate patterns
+        regexes = self.regex.regexes if isinstance(self.regex, _RegexSet) else [self.regex]
+        separate = index - (len(regexes) - len(self._separate_patterns))
+        if separate >= 0:
+            return self._separate_patterns[separate]
+        if match.lastgroup != 'literals':
+            return self.patterns[int(match.lastgroup[1:])]
+        text = match.group()
+        pattern = self._literal_patterns.get(text.lower() if self.case_insensitive and text.isascii() else text)
+        if pattern is None:
+            # non-ASCII text that only matches case-insensitively
+            pattern = next(pattern for word, pattern in self._literal_patterns.items()
+                           if re.fullmatch(re.escape(word), text, re.IGNORECASE))
+        return pattern
+
+    def __str__(self):
+        return _quote_patterns(self.patterns)
+
+    def __getstate__(self):
+        return self.patterns, self.case_insensitive
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def compile_pattern(search_pattern, case_insensitive: bool = False) -> CompiledPattern:
+    """
+    Compile a search pattern, patterns that are compiled already are returned as they are.
+
+    :param search_pattern: pattern to search for, a string or a CompiledPattern
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :return: the compiled pattern
+    """
+    if isinstance(search_pattern, CompiledPattern):
+        return search_pattern
+    return CompiledPattern(search_pattern, case_insensitive)
+
+
+class SearchStats:
+    """
+    Counters and phase timers of a search, reported with --stats.
+
+    The search functions take an optional SearchStats and only touch it per file or per batch of lines, a search
+    without one pays nothing but a few `is not None` checks.
+    """
+
+    # phases the time of a search is spent in
+    PHASES = ('walk', 'read', 'match', 'output')
+
+    def __init__(self):
+        self.files_walked = 0
+        self.files_searched = 0
+        self.bytes_read = 0
+        self.lines_scanned = 0
+        self.matches = 0
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+
+    def add(self, other):
+        """
+        Add the counters and times of another SearchStats, e.g. of a worker process.
+
+        :param other: stats to add
+        """
+        self.files_walked += other.files_walked
+        self.files_searched += other.files_searched
+        self.bytes_read += other.bytes_read
+        self.lines_scanned += other.lines_scanned
+        self.matches += other.matches
+        for phase in self.PHASES:
+            self.times[phase] += other.times[phase]
+
+    def take(self):
+        """
+        Hand the counters and times over and start again from zero.
+
+        :return: SearchStats with the counters and times collected so far
+        """
+        taken = SearchStats()
+        taken.add(self)
+        self.__init__()
+        return taken
+
+    def timed(self, iterable, phase: str):
+        """
+        Add the time spent producing the items of an iterable to a phase.
+
+        :param iterable: iterable whose items are produced while they are asked for, e.g. the walk of a directory
+        :param phase: one of PHASES
+        :return: generator of the items of the iterable
+        """
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.times[phase] += time.perf_counter() - started
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def file_opened(self, started: float) -> float:
+        """
+        Count a file that is searched, the time since it started to be opened is read time.
+
+        :param started: time.perf_counter() before the file was opened
+        :return: time.perf_counter() now, when the search of the file starts
+        """
+        now = time.perf_counter()
+        self.times['read'] += now - started
+        self.files_searched += 1
+        return now
+
+    def file_searched(self, started: float, matches: int):
+        """
+        Count the matches of a searched file, the time since its search started is match time.
+
+        The bytes and lines of the file are counted by the search itself, see search_pattern_in_file.
+
+        :param started: time.perf_counter() when the search started, see file_opened
+        :param matches: number of matching lines
+        """
+        self.times['match'] += time.perf_counter() - started
+        self.matches += matches
+
+    def report(self) -> list:
+        """
+        :return: list of lines reporting the counters and the times
+        """
+        times = ', '.join(f"{phase} {self.times[phase]:.3f}s" for phase in self.PHASES)
+        return [
+            f"files: {self.files_walked} walked, {self.files_walked - self.files_searched} skipped, "
+            f"{self.files_searched} searched",
+            f"bytes read: {self.bytes_read}",
+            f"lines scanned: {self.lines_scanned}",
+            f"matches: {self.matches}",
+            f"time: {times}",
+        ]
+
+
+def _count_scanned(stats: SearchStats, buffer, end: int):
+    """
+    Count the bytes and lines of a buffer that were scanned, a last line without a line break counts as well.
+
+    :param stats: stats to count the bytes and lines in
+    :param buffer: bytes-like object that was searched
+    :param end: offset the search got to, it may be past the end of the buffer
+    """
+    size = len(buffer)
+    end = min(end, size)
+    stats.bytes_read += end
+    stats.lines_scanned += _count_newlines(buffer, 0, end)
+    if end == size and size and buffer[size - 1:size] != b'\n':
+        stats.lines_scanned += 1
+
+
+def _counted_lines(lines, stats: SearchStats):
+    """
+    Count the lines of a stream of lines as they are read.
+
+    :param lines: iterable of lines
+    :param stats: stats to count the lines in
+    :return: generator of the lines
+    """
+    for line in lines:
+        stats.lines_scanned += 1
+        yield line
+
+
+class _CountingReader(io.BufferedIOBase):
+    """
+    Count the bytes read from a binary stream, e.g. the ones a TextIOWrapper reads ahead to decode.
+    """
+
+    def __init__(self, stream, stats: SearchStats):
+        """
+        :param stream: file opened in binary mode, it is left open
+        :param stats: stats to count the bytes in
+        """
+        super().__init__()
+        self._stream = stream
+        self._stats = stats
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._stats.bytes_read += len(data)
+        return data
+
+    def read1(self, size: int = -1) -> bytes:
+        data = getattr(self._stream, 'read1', self._stream.read)(size)
+        self._stats.bytes_read += len(data)
+        return data
+
+
+def _instrumented_lines(lines, stats: SearchStats):
+    """
+    Count the matches among the output lines of a search run with the filename '' and strip their prefixes.
+
+    The time spent producing the lines is match time.
+
+    :param lines: iterable of output lines prefixed with ': ' or '- ', see _format_lines
+    :param stats: stats to count the matches in
+    :return: generator of the output lines without their prefixes
+    """
+    for line in stats.timed(lines, 'match'):
+        if line.startswith(': '):
+            stats.matches += 1
+            yield line[2:]
+        elif line.startswith('- '):
+            yield line[2:]
+        else:
+            yield line
+
+
+class _ContextWindow:
+    """
+    Expand the matching lines of a line stream with the lines before and after every match.
+
+    Overlapping windows are merged so every line is output at most once, and with lines around the matches
+    GROUP_SEPARATOR is output between two groups of lines that are not adjacent. Only the last `lines_before` lines
+    are kept in memory, so the memory use does not depend on the size of the input and the cost does not depend on
+    the size of the windows. The state is kept between calls of `lines`, so a stream that is searched in parts, e.g.
+    a followed file, is expanded like a whole one.
+    """
+
+    def __init__(self, lines_before: int = 0, lines_after: int = 0, label=None, max_count: int = None):
+        """
+        :param lines_before: number of lines to include before a match (default is 0)
+        :param lines_after: number of lines to include after a match (default is 0)
+        :param label: function returning the pattern that matches a line, the matching lines are prefixed with it
+                      (default is None, no prefix)
+        :param max_count: stop after this number of matching lines and the lines after the last of them (default is
+                          None, no limit)
+        """
+        self.lines_before = lines_before
+        self.lines_after = lines_after
+        self.label = label
+        self.max_count = max_count
+        self.window = deque(maxlen=lines_before)  # lines after the last output line that may come before the next match
+        self.last_output = None  # number of the last output line
+        self.last_after = -1  # number of the last line after the latest match
+        self.previous = None  # number of the last line seen
+        self.matches = 0
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether max_count matching lines and the lines after the last of them were output, no more lines are needed.
+        """
+        return self.matches == self.max_count and (self.previous is None or self.previous >= self.last_after)
+
+    def lines(self, events):
+        """
+        Expand the next part of the line stream.
+
+        :param events: iterable of (line number, line, matched) tuples in ascending line order, a gap in the line
+                       numbers drops the lines kept for the next match
+        :return: generator of (line number, line, matched) tuples to output, a separator has no line number; once
+                 max_count is reached no more events are read
+        """
+        # the state is kept in local variables while the events are read and stored back at the end
+        window, lines_before, lines_after, label, max_count = (self.window, self.lines_before, self.lines_after,
+                                                               self.label, self.max_count)
+        last_output, last_after, previous, matches = self.last_output, self.last_after, self.previous, self.matches
+        # without lines around the matches, e.g. with only the matched pattern shown, there are no groups to separate
+        separate = bool(lines_before or lines_after)
+        try:
+            for number, line, matched in events:
+                if previous is not None and number != previous + 1:
+                    window.clear()
+                previous = number
+                if matched and matches != max_count:
+                    matches += 1
+                    first = window[0][0] if window else number
+                    if separate and last_output is not None and first > last_output + 1:
+                        yield None, GROUP_SEPARATOR, False
+                    yield from window
+                    window.clear()
+                    yield number, f"[{label(line)}] {line.strip()}" if label else line.strip(), True
+                    last_output, last_after = number, number + lines_after
+                elif number <= last_after:
+                    yield number, line.strip("\n"), False
+                    last_output = number
+                elif matches == max_count:
+                    return
+                elif lines_before:
+                    window.append((number, line.strip("\n"), False))
+        finally:
+            self.last_output, self.last_after, self.previous, self.matches = last_output, last_after, previous, matches
+
+
+def _context_lines(events, lines_before: int = 0, lines_after: int = 0, label=None, max_count: int = None):
+    """
+    Expand the matching lines of a whole line stream with the lines before and after every match, see _ContextWindow.
+
+    :param events: iterable of (line number, line, matched) tuples in ascending line order, a gap in the line numbers
+                   drops the lines kept for the next match
+    :param lines_before: number of lines to include before a match (default is 0)
+    :param lines_after: number of lines to include after a match (default is 0)
+    :param label: function returning the pattern that matches a line, the matching lines are prefixed with it
+                  (default is None, no prefix)
+    :param max_count: stop after this number of matching lines and the lines after the last of them, no more events
+                      are read then (default is None, no limit)
+    :return: generator of (line number, line, matched) tuples to output, a separator has no line number
+    """
+    return _ContextWindow(lines_before, lines_after, label, max_count).lines(events)
+
+
+def _format_lines(lines, filename: str = None):
+    """
+    Turn the lines of _context_lines into output lines.
+
+    :param lines: iterable of (line number, line, matched) tuples
+    :param filename: name to prefix the lines with, 'name: ' for a matching line and 'name- ' for a line around a
+                     match (default is None, no prefix)
+    :return: generator of output lines
+    """
+    if filename is None:
+        for _, line, _ in lines:
+            yield line
+        return
+    for number, line, matched in lines:
+        if number is None:
+            yield line
+        else:
+            yield f"{filename}{':' if matched else '-'} {line}"
+
+
+def search_pattern_in_stream(search_pattern, lines, case_insensitive: bool = False, lines_before: int = 0,
+                             lines_after: int = 0, show_pattern: bool = False, max_count: int = None,
+                             filename: str = None):
+    """
+    Search a pattern in a stream of lines and yield the matching lines as soon as they are found.
+
+    :param search_pattern: pattern to search for, a string or a CompiledPattern
+    :param lines: iterable of lines to search from, e.g. an open file or STDIN
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :param lines_before: number of lines to include before a match (default is 0)
+    :param lines_after: number of lines to include after a match (default is 0)
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it (default is False)
+    :param max_count: stop reading after this number of matching lines (default is None, read to the end)
+    :param filename: name to prefix the lines with, see _format_lines (default is None, no prefix)
+    :return: generator of matching lines
+    """
+    pattern = compile_pattern(search_pattern, case_insensitive)
+    if max_count == 0:
+        return
+    if not lines_before and not lines_after and not show_pattern:
+        prefix = f"{filename}: " if filename is not None else ""
+        count = 0
+        if pattern.literal is not None and not pattern.case_insensitive:
+            literal = pattern.literal
+            for line in lines:
+                if literal in line:
+                    yield prefix + line.strip()
+                    count += 1
+                    if count == max_count:
+                        return
+        else:
+            search = pattern.search
+            for line in lines:
+                if search(line):
+                    yield prefix + line.strip()
+                    count += 1
+                    if count == max_count:
+                        return
+        return
+
+    search = pattern.search
+    events = ((number, line, bool(search(line))) for number, line in enumerate(lines))
+    label = pattern.matched_pattern if show_pattern else None
+    yield from _format_lines(_context_lines(events, lines_before, lines_after, label, max_count), filename)
+
+
+def _count_newlines(buffer, start: int, end: int) -> int:
+    """
+    Count the line breaks in a part of a buffer, at most READ_CHUNK_SIZE bytes are copied at a time.
+
+    :param buffer: bytes-like object, e.g. a memory-mapped file
+    :param start: offset to start counting at
+    :param end: offset to stop counting at
+    :return: the number of line breaks
+    """
+    count = 0
+    for offset in range(start, end, READ_CHUNK_SIZE):
+        count += buffer[offset:min(offset + READ_CHUNK_SIZE, end)].count(b'\n')
+    return count
+
+
+def _buffer_events(regex, buffer, lines_before: int, lines_after: int, encoding: str, stats: SearchStats = None):
+    """
+    Find the matching lines of a buffer and the lines around them, every other line is skipped without decoding it.
+
+    :param regex: compiled bytes pattern
+    :param buffer: bytes-like object to search, e.g. a memory-mapped file
+    :param lines_before: number of lines to include before a match
+    :param lines_after: number of lines to include after a match
+    :param encoding: encoding of the buffer
+    :param stats: stats to count the scanned bytes and lines in (default is None, nothing is counted)
+    :return: generator of (line number, line, matched) tuples
+    """
+    size = len(buffer)
+    counted_offset, counted_number = 0, 0  # start and number of the last line whose number is known
+    next_offset, next_number = 0, 0  # start and number of the first line that was not handed out yet
+    last_after = -1  # number of the last line after the previous match
+    position = 0
+    try:
+        while position < size:
+            match = regex.search(buffer, position)
+            if match is None or match.start() == size and buffer[size - 1:size] == b'\n':
+                # an empty match after the last line break is not a line
+                position = size
+                break
+            start = buffer.rfind(b'\n', 0, match.start()) + 1
+            end = buffer.find(b'\n', match.start())
+            if end == -1:
+                end = size
+            number = counted_number + _count_newlines(buffer, counted_offset, start)
+            counted_offset, counted_number = start, number
+
+            # lines after the previous match
+            while next_number < number and next_number <= last_after:
+                line_end = buffer.find(b'\n', next_offset)
+                yield next_number, buffer[next_offset:line_end].decode(encoding, DECODE_ERRORS), False
+                next_offset, next_number = line_end + 1, next_number + 1
+
+            # lines before this match
+            first = max(next_number, number - lines_before)
+            if first < number:
+                if first == next_number:
+                    offset = next_offset
+                else:
+                    offset = start
+                    for _ in range(number - first):
+                        offset = buffer.rfind(b'\n', 0, offset - 1) + 1
+                for before_number in range(first, number):
+                    line_end = buffer.find(b'\n', offset)
+                    yield before_number, buffer[offset:line_end].decode(encoding, DECODE_ERRORS), False
+                    offset = line_end + 1
+
+            position = end + 1
+            yield number, buffer[start:end].decode(encoding, DECODE_ERRORS), True
+            next_offset, next_number = end + 1, number + 1
+            last_after = number + lines_after
+
+        # lines after the last match
+        while next_number <= last_after and next_offset < size:
+            line_end = buffer.find(b'\n', next_offset)
+            if line_end == -1:
+                line_end = size
+            yield next_number, buffer[next_offset:line_end].decode(encoding, DECODE_ERRORS), False
+            next_offset, next_number = line_end + 1, next_number + 1
+    finally:
+        if stats is not None:
+            # the search got to the end of the last matching line or of the last line handed out after it
+            _count_scanned(stats, buffer, max(position, next_offset))
+
+
+def search_pattern_in_buffer(search_pattern, buffer, case_insensitive: bool = False, lines_before: int = 0,
+                             lines_after: int = 0, encoding: str = 'utf-8', show_pattern: bool = False,
+                             max_count: int = None, filename: str = None, stats: SearchStats = None):
+    """
+    Search a pattern in a whole buffer at once and yield the same lines as search_pattern_in_stream.
+
+    The pattern runs over the raw bytes, line boundaries are only worked out around each match and only the lines
+    that are output get decoded.
+
+    :param search_pattern: pattern to search for, a string or a CompiledPattern with a bytes version for the encoding
+    :param buffer: bytes-like object to search, e.g. a memory-mapped file
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :param lines_before: number of lines to include before a match (default is 0)
+    :param lines_after: number of lines to include after a match (default is 0)
+    :param encoding: encoding of the buffer, UTF-8 or an ASCII compatible single-byte encoding (default is 'utf-8')
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it (default is False)
+    :param max_count: stop searching after this number of matching lines (default is None, search the whole buffer)
+    :param filename: name to prefix the lines with, see _format_lines (default is None, no prefix)
+    :param stats: stats to count the bytes and lines in that were scanned before the search stopped (default is
+                  None, nothing is counted)
+    :return: generator of matching lines
+    """
+    pattern = compile_pattern(search_pattern, case_insensitive)
+    regex = pattern.bytes_regex_for(encoding)
+    if regex is None:
+        raise ValueError(f"Pattern {pattern} can not be searched in raw bytes.")
+    if max_count == 0:
+        return
+
+    if not lines_before and not lines_after and not show_pattern:
+        prefix = f"{filename}: " if filename is not None else ""
+        size = len(buffer)
+        position = 0
+        count = 0
+        try:
+            while position < size:
+                match = regex.search(buffer, position)
+                if match is None or match.start() == size and buffer[size - 1:size] == b'\n':
+                    position = size
+                    break
+                start = buffer.rfind(b'\n', 0, match.start()) + 1
+                end = buffer.find(b'\n', match.start())
+                if end == -1:
+                    end = size
+                position = end + 1
+                yield prefix + buffer[start:end].decode(encoding, DECODE_ERRORS).strip()
+                count += 1
+                if count == max_count:
+                    return
+        finally:
+            if stats is not None:
+                _count_scanned(stats, buffer, position)
+        return
+
+    events = _buffer_events(regex, buffer, lines_before, lines_after, encoding, stats)
+    label = pattern.matched_pattern if show_pattern else None
+    try:
+        yield from _format_lines(_context_lines(events, lines_before, lines_after, label, max_count), filename)
+    finally:
+        # the lines scanned are counted when the events stop, also when the search stops before their end
+        events.close()
+
+
+def _line_chunks(stream):
+    """
+    Read a binary stream in chunks of whole lines, line breaks are turned into b'\n' like text mode does.
+
+    :param stream: file opened in binary mode
+    :return: generator of chunks as bytes, every chunk but the last one ends with a line break
+    """
+    read = getattr(stream, 'read1', stream.read)
+    rest = b''
+    while True:
+        # read1 returns what is available, lines of a slow pipe are searched as soon as they arrive
+        data = read(READ_CHUNK_SIZE)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(b'\n') + 1
+        chunk, rest = data[:end], data[end:]
+        if chunk:
+            yield chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n') if b'\r' in chunk else chunk
+    if rest:
+        yield rest.replace(b'\r\n', b'\n').replace(b'\r', b'\n') if b'\r' in rest else rest
+
+
+def search_pattern_in_chunks(search_pattern, chunks, case_insensitive: bool = False, lines_before: int = 0,
+                             lines_after: int = 0, encoding: str = 'utf-8', show_pattern: bool = False,
+                             max_count: int = None, filename: str = None, stats: SearchStats = None):
+    """
+    Search a pattern in undecoded chunks of whole lines and yield the same lines as search_pattern_in_stream.
+
+    Without lines around the matches every chunk is searched as a whole buffer, otherwise the chunks are split into
+    lines. Either way the pattern runs over the raw bytes and only the lines that are output get decoded.
+
+    :param search_pattern: pattern to search for, a string or a CompiledPattern with a bytes version for the encoding
+    :param chunks: iterable of chunks of lines ending with b'\n', see _line_chunks
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :param lines_before: number of lines to include before a match (default is 0)
+    :param lines_after: number of lines to include after a match (default is 0)
+    :param encoding: encoding of the lines, UTF-8 or an ASCII compatible single-byte encoding (default is 'utf-8')
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it (default is False)
+    :param max_count: stop reading after this number of matching lines (default is None, read to the end)
+    :param filename: name to prefix the lines with, see _format_lines (default is None, no prefix)
+    :param stats: stats to count the lines in that were scanned before the search stopped, the bytes are counted
+                  while the chunks are read, see _CountingReader (default is None, nothing is counted)
+    :return: generator of matching lines
+    """
+    pattern = compile_pattern(search_pattern, case_insensitive)
+    regex = pattern.bytes_regex_for(encoding)
+    if regex is None:
+        raise ValueError(f"Pattern {pattern} can not be searched in raw bytes.")
+    if max_count == 0:
+        return
+
+    if not lines_before and not lines_after and not show_pattern:
+        count = 0
+        # the chunks lost their '\r' bytes, only the lines scanned in them are counted
+        scanned = SearchStats() if stats is not None else None
+        try:
+            for chunk in chunks:
+                lines = search_pattern_in_buffer(pattern, chunk, encoding=encoding,
+                                                 max_count=None if max_count is None else max_count - count,
+                                                 filename=filename, stats=scanned)
+                try:
+                    for line in lines:
+                        yield line
+                        count += 1
+                finally:
+                    lines.close()
+                if count == max_count:
+                    return
+        finally:
+            if stats is not None:
+                stats.lines_scanned += scanned.lines_scanned
+        return
+
+    def events():
+        # the lines that can not be output are left out, _context_lines drops its window at the gap
+        last_after = -1
+        lines = (line for chunk in chunks for line in chunk.splitlines(keepends=True))
+        for number, line in enumerate(lines):
+            if stats is not None:
+                stats.lines_scanned += 1
+            # the line break is left out, otherwise '^' of the multiline pattern also matches after it
+            matched = regex.search(line, 0, len(line) - line.endswith(b'\n')) is not None
+            if matched:
+                last_after = number + lines_after
+            if matched or lines_before or number <= last_after:
+                yield number, line.decode(encoding, DECODE_ERRORS), matched
+
+    label = pattern.matched_pattern if show_pattern else None
+    yield from _format_lines(_context_lines(events(), lines_before, lines_after, label, max_count), filename)
+
+
+def search_pattern_in_file(search_pattern, stream, case_insensitive: bool = False, lines_before: int = 0,
+                           lines_after: int = 0, encoding: str = 'utf-8', show_pattern: bool = False,
+                           max_count: int = None, filename: str = None, stats: SearchStats = None):
+    """
+    Search a pattern in an open binary file and close it once the search is done.
+
+    When the pattern has a bytes version for the encoding, regular files are memory-mapped and searched as a whole
+    buffer and other files are searched line by line without decoding them. Otherwise the lines are decoded and
+    searched as text. Bytes that are not valid in the encoding are replaced, they never stop the search.
+
+    :param search_pattern: pattern to search for, a string or a CompiledPattern
+    :param stream: file opened in binary mode
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :param lines_before: number of lines to include before a match (default is 0)
+    :param lines_after: number of lines to include after a match (default is 0)
+    :param encoding: encoding of the file (default is 'utf-8')
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it (default is False)
+    :param max_count: stop reading after this number of matching lines (default is None, read to the end)
+    :param filename: name to prefix the lines with, see _format_lines (default is None, no prefix)
+    :param stats: stats to count the bytes and lines in that were read before the search stopped, the bytes of a
+                  compressed file are counted decompressed (default is None, nothing is counted)
+    :return: generator of matching lines
+    """
+    pattern = compile_pattern(search_pattern, case_insensitive)
+    with stream:
+        if pattern.bytes_regex_for(encoding) is not None:
+            buffer = _map_file(stream)
+            if buffer is not None:
+                with buffer:
+                    # text mode turns a '\r' into a line break, those files are read in chunks whose line breaks
+                    # are turned into b'\n'
+                    if buffer.find(b'\r') == -1:
+                        yield from search_pattern_in_buffer(pattern, buffer, case_insensitive, lines_before,
+                                                            lines_after, encoding, show_pattern, max_count, filename,
+                                                            stats)
+                        return
+            chunks = _line_chunks(stream if stats is None else _CountingReader(stream, stats))
+            yield from search_pattern_in_chunks(pattern, chunks, case_insensitive, lines_before, lines_after,
+                                                encoding, show_pattern, max_count, filename, stats)
+            return
+        lines = io.TextIOWrapper(stream if stats is None else _CountingReader(stream, stats), encoding=encoding,
+                                 errors=DECODE_ERRORS)
+        try:
+            yield from search_pattern_in_stream(pattern, lines if stats is None else _counted_lines(lines, stats),
+                                                case_insensitive, lines_before, lines_after, show_pattern, max_count,
+                                                filename)
+        finally:
+            # the file itself is closed by the with statement
+            lines.detach()
+
+
+def _encoding_error(encoding: str):
+    """
+    Check that an encoding is known and decodes bytes to text.
+
+    :param encoding: encoding to check
+    :return: the error message or None if input can be read in the encoding
+    """
+    try:
+        codec = codecs.lookup(encoding)
+    except LookupError:
+        return f"Unknown encoding '{encoding}'."
+    # codecs like 'hex' or 'rot13' turn bytes into bytes or text into text, str.decode refuses them
+    if not getattr(codec, '_is_text_encoding', True):
+        return f"Encoding '{encoding}' is not a text encoding."
+    return None
+
+
+def _is_utf8(encoding: str) -> bool:
+    return codecs.lookup(encoding).name == 'utf-8'
+
+
+@functools.lru_cache()
+def _is_ascii_compatible(encoding: str) -> bool:
+    # ASCII bytes are read as the same ASCII characters, e.g. UTF-8 or latin-1 but not UTF-16
+    ascii_bytes = bytes(range(128))
+    try:
+        return ascii_bytes.decode(encoding) == ascii_bytes.decode('ascii')
+    except (UnicodeError, LookupError):
+        return False
+
+
+def _is_single_byte(encoding: str) -> bool:
+    # one character per byte and ASCII bytes are ASCII characters, e.g. latin-1 or cp1252
+    try:
+        text = bytes(range(256)).decode(encoding, DECODE_ERRORS)
+    except LookupError:
+        return False
+    return len(text) == 256 and text[:128] == bytes(range(128)).decode('ascii')
+
+
+def _map_file(stream):
+    """
+    Memory-map an open file for reading.
+
+    :param stream: open binary file
+    :return: the read-only memory map or None if the file is not a regular file, is empty or can not be mapped
+    """
+    if not isinstance(getattr(stream, 'raw', None), io.FileIO):
+        # e.g. a decompressing stream, its file descriptor is the one of the compressed file
+        return None
+    try:
+        file_stat = os.fstat(stream.fileno())
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+            return None
+        buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if hasattr(buffer, 'madvise'):
+        buffer.madvise(mmap.MADV_SEQUENTIAL)
+    return buffer
+
+
+def _compression_module(stream):
+    """
+    Tell the format of a compressed file by its first bytes, without reading them from the stream.
+
+    :param stream: file opened in binary mode with a peek method
+    :return: the module that decompresses the file (gzip, bz2 or lzma) or None if it is not compressed
+    """
+    head = stream.peek(6)[:6]
+    for magic, module in COMPRESSION_FORMATS:
+        if head.startswith(magic):
+            return module
+    return None
+
+
+def open_input(filepath: str, search_compressed: bool = False):
+    """
+    Open a file for searching, compressed files are decompressed in chunks while they are read.
+
+    :param filepath: file to open
+    :param search_compressed: flag to decompress gzip, bzip2 and xz files, told apart by their first bytes (default
+                              is False, search every file as it is)
+    :return: the file opened in binary mode
+    """
+    stream = open(filepath, 'rb', buffering=READ_CHUNK_SIZE)
+    if search_compressed:
+        module = _compression_module(stream)
+        if module is not None:
+            stream.close()
+            return module.open(filepath, 'rb')
+    return stream
+
+
+def search_pattern_in_strings(search_pattern, array_of_strings: list, case_insensitive: bool = False,
+                              lines_before: int = 0, lines_after: int = 0, stats: SearchStats = None) -> list:
+    """
+    Search a pattern from list of strings and return the matching lines.
+
+    :param search_pattern: pattern to search for, a string or a CompiledPattern
+    :param array_of_strings: list of strings to search from
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :param lines_before: number of lines to include before a match (default is 0)
+    :param lines_after: number of lines to include after a match (default is 0)
+    :param stats: stats to count the scanned lines, the matches and the match time in (default is None)
+    :return: list of matching lines
+    """
+    if not array_of_strings:
+        return "", []
+
+    if stats is None:
+        return "", list(search_pattern_in_stream(search_pattern, array_of_strings, case_insensitive, lines_before,
+                                                 lines_after))
+    started = time.perf_counter()
+    result = list(search_pattern_in_stream(search_pattern, array_of_strings, case_insensitive, lines_before,
+                                           lines_after))
+    stats.times['match'] += time.perf_counter() - started
+    stats.lines_scanned += len(array_of_strings)
+    if lines_before or lines_after:
+        # the output has the lines around the matches as well, the matches are counted again outside the timer
+        pattern = compile_pattern(search_pattern, case_insensitive)
+        stats.matches += sum(1 for line in array_of_strings if pattern.search(line))
+    else:
+        stats.matches += len(result)
+    return "", result
+
+
+def _compile_globs(globs):
+    """
+    Compile shell globs into a single regular expression.
+
+    :param globs: list of globs like '*.py', may be None
+    :return: compiled regular expression matching any of the globs or None if there are no globs
+    """
+    if not globs:
+        return None
+    return re.compile('|'.join(fnmatch.translate(glob) for glob in globs))
+
+
+def _ignore_rule_regex(rule: str) -> str:
+    """
+    Translate the glob of a .gitignore rule into a regular expression for paths with '/' separators.
+
+    :param rule: glob of the rule without the negation, anchoring and directory markers
+    :return: regular expression source
+    """
+    regex = []
+    i = 0
+    while i < len(rule):
+        char = rule[i]
+        if rule.startswith('**/', i):
+            # any number of directories, including none
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if rule.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[' and rule.find(']', i + 2) != -1:
+            end = rule.find(']', i + 2)
+            body = rule[i + 1:end]
+            negated = body[:1] in ('!', '^')
+            if negated:
+                body = body[1:]
+            body = ''.join('\\' + c if c in '\\[]^' else c for c in body)
+            regex.append(f"[^/{body}]" if negated else f"[{body}]")
+            i = end
+        elif char == '\\' and i + 1 < len(rule):
+            i += 1
+            regex.append(re.escape(rule[i]))
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ''.join(regex)
+
+
+class IgnoreRules:
+    """
+    Rules of the .gitignore and .ignore files of one directory compiled into a single regular expression.
+
+    The rules are joined in reverse order so the first alternative that matches is the last rule of the files, which
+    is the one that decides like in git.
+    """
+
+    IGNORE_FILE_NAMES = ('.gitignore', '.ignore')
+
+    def __init__(self, lines):
+        """
+        :param lines: lines of the ignore files, later lines take precedence
+        """
+        sources = []
+        self.negated = []
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if line.endswith(' ') and not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # a rule with a '/' in it is relative to the directory of the ignore file, other rules match at any depth
+            prefix = '' if '/' in line else '(?:.*/)?'
+            sources.append(prefix + _ignore_rule_regex(line.lstrip('/')) + ('/' if directory_only else '/?'))
+            self.negated.append(negated)
+        self.regex = None
+        if sources:
+            self.regex = re.compile('|'.join(f"(?P<r{index}>{source})"
+                                             for index, source in reversed(list(enumerate(sources)))))
+
+    @classmethod
+    def from_directory(cls, directory: str):
+        """
+        Read the ignore files of a directory.
+
+        :param directory: directory to read the ignore files from
+        :return: the compiled rules or None if the directory has no ignore rules
+        """
+        lines = []
+        for name in cls.IGNORE_FILE_NAMES:
+            try:
+                with open(os.path.join(directory, name), 'r', errors='replace') as ignore_file:
+                    lines.extend(ignore_file)
+            except OSError:
+                continue
+        rules = cls(lines)
+        return rules if rules.regex is not None else None
+
+    def match(self, relative_path: str, is_dir: bool):
+        """
+        Check a path against the rules.
+
+        :param relative_path: path relative to the directory of the ignore files with '/' separators
+        :param is_dir: flag telling if the path is a directory
+        :return: True if the path is ignored, False if a negated rule includes it again, None if no rule matches
+        """
+        match = self.regex.fullmatch(relative_path + '/' if is_dir else relative_path)
+        if match is None:
+            return None
+        return not self.negated[int(match.lastgroup[1:])]
+
+
+class PathFilter:
+    """
+    Decide which files and directories a recursive search skips.
+
+    The globs are compiled once and the ignore files of every directory are read once while the directories are
+    walked.
+    """
+
+    def __init__(self, include: list = None, exclude: list = None, exclude_dir: list = None,
+                 ignore_files: bool = False):
+        """
+        :param include: globs of the file names to search, all the files are searched if empty
+        :param exclude: globs of the file names to skip
+        :param exclude_dir: globs of the directory names to skip
+        :param ignore_files: flag to skip the files and directories listed in .gitignore and .ignore files and the
+                             .git directories
+        """
+        self.include = _compile_globs(include)
+        self.exclude = _compile_globs(exclude)
+        self.exclude_dir = _compile_globs(exclude_dir)
+        self.ignore_files = ignore_files
+        self._rules = {}  # directory -> list of (directory of the ignore files, IgnoreRules), deepest first
+
+    def enter(self, root: str):
+        """
+        Read the ignore files of a directory before its entries are checked, the parent must have been entered first.
+
+        :param root: directory that is walked
+        """
+        if not self.ignore_files:
+            return
+        inherited = self._rules.pop(root, [])
+        rules = IgnoreRules.from_directory(root)
+        self._rules[root] = [(root, rules)] + inherited if rules is not None else inherited
+
+    def _ignored(self, root: str, name: str, is_dir: bool) -> bool:
+        path = os.path.join(root, name)
+        for base, rules in self._rules.get(root, []):
+            decision = rules.match(path[len(base):].lstrip(os.sep).replace(os.sep, '/'), is_dir)
+            if decision is not None:
+                return decision
+        return False
+
+    def skip_dir(self, root: str, name: str) -> bool:
+        """
+        :param root: directory that is walked
+        :param name: name of the subdirectory
+        :return: True if the subdirectory and everything in it is skipped
+        """
+        if self.exclude_dir is not None and self.exclude_dir.match(name):
+            return True
+        if self.ignore_files:
+            if name == '.git' or self._ignored(root, name, True):
+                return True
+            # the subdirectory starts with the rules of this directory
+            self._rules[os.path.join(root, name)] = self._rules.get(root, [])
+        return False
+
+    def skip_file(self, root: str, name: str) -> bool:
+        """
+        :param root: directory that is walked
+        :param name: name of the file
+        :return: True if the file is skipped
+        """
+        if self.include is not None and not self.include.match(name):
+            return True
+        if self.exclude is not None and self.exclude.match(name):
+            return True
+        return self.ignore_files and self._ignored(root, name, False)
+
+
+class DirectoryListing:
+    """
+    Cache of the entries of directories for repeated walks of the same tree.
+
+    A directory is listed again only when its modification time changed, i.e. when an entry was added, removed or
+    renamed. Only the names are cached, the files themselves are always read from disk.
+    """
+
+    def __init__(self):
+        # directory -> (modification time in ns, names of the subdirectories, names of the regular files)
+        self._entries = {}
+
+    def list(self, directory: str) -> tuple:
+        """
+        List a directory, from the cache if it did not change since it was listed.
+
+        :param directory: directory to list
+        :return: tuple with the list of the names of the subdirectories and the list of the names of the regular files
+        """
+        mtime_ns = os.stat(directory).st_mtime_ns
+        entry = self._entries.get(directory)
+        if entry is None or entry[0] != mtime_ns:
+            dirs, files = [], []
+            with os.scandir(directory) as entries:
+                for dir_entry in entries:
+                    # like os.walk, symbolic links to directories are not followed
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        dirs.append(dir_entry.name)
+                    elif dir_entry.is_file():
+                        files.append(dir_entry.name)
+            entry = self._entries[directory] = (mtime_ns, dirs, files)
+        return list(entry[1]), entry[2]
+
+    def walk(self, directory: str):
+        """
+        Walk a directory top-down like os.walk, directories removed from the yielded list are not walked.
+
+        :param directory: directory to walk
+        :return: generator of (directory, names of the subdirectories, names of the regular files) tuples
+        """
+        pending = [directory]
+        while pending:
+            root = pending.pop()
+            try:
+                dirs, files = self.list(root)
+            except OSError:
+                # removed since its parent was listed, or not readable
+                continue
+            yield root, dirs, files
+            pending.extend(os.path.join(root, name) for name in reversed(dirs))
+
+
+def _walk_files(directory: str, path_filter: PathFilter = None, stats: SearchStats = None,
+                listing: DirectoryListing = None):
+    """
+    Walk a directory and its subdirectories and yield the path of every file in it.
+
+    Skipped directories are removed from the walk before it descends into them, nothing under them is ever read.
+
+    :param directory: directory to walk
+    :param path_filter: filter deciding which files and directories are skipped (default is None, nothing is skipped)
+    :param stats: stats to count the files of the walk in, also the skipped ones (default is None)
+    :param listing: cache of the directory entries to walk with (default is None, list every directory again)
+    :return: generator of file paths
+    """
+    for root, dirs, files in (listing.walk(directory) if listing is not None else os.walk(directory)):
+        if stats is not None:
+            stats.files_walked += len(files) - (len(INDEX_FILE_NAMES.intersection(files)) if root == directory else 0)
+        if path_filter is not None:
+            path_filter.enter(root)
+            dirs[:] = [name for name in dirs if not path_filter.skip_dir(root, name)]
+            files = [name for name in files if not path_filter.skip_file(root, name)]
+        for file in files:
+            if root == directory and file in INDEX_FILE_NAMES:
+                # the trigram index of the directory and its journal
+                continue
+            filepath = os.path.join(root, file)
+            # the listing only has regular files
+            if listing is not None or os.path.isfile(filepath):
+                yield filepath
+
+
+def _looks_binary(sample: bytes, encoding: str) -> bool:
+    """
+    Tell binary files from text files by the first bytes of the file.
+
+    :param sample: first bytes of the file
+    :param encoding: encoding the file is read with
+    :return: True if the file contains a NUL byte or, for UTF-8, bytes that are not valid UTF-8
+    """
+    name = codecs.lookup(encoding).name
+    if b'\0' in sample and not name.startswith(('utf-16', 'utf-32')):
+        return True
+    if name == 'utf-8':
+        try:
+            sample.decode('utf-8')
+        except UnicodeDecodeError as err:
+            # the sample may end in the middle of a character
+            return not (err.reason == 'unexpected end of data' and err.end == len(sample))
+    return False
+
+
+def _count_binary_matches(pattern: CompiledPattern, stream, encoding: str, limit: int = 0,
+                          stats: SearchStats = None) -> int:
+    """
+    Count the matching lines of a binary file without decoding it.
+
+    :param pattern: compiled pattern to search for
+    :param stream: file opened in binary mode
+    :param encoding: encoding used to decode lines when the pattern has no bytes version
+    :param limit: stop counting at this number of matches (default is 0, count all the matches)
+    :param stats: stats to count the bytes and lines in that were scanned before the count stopped (default is None,
+                  nothing is counted)
+    :return: the number of matching lines
+    """
+    regex = pattern.binary_regex
+    buffer = _map_file(stream) if regex is not None else None
+    count = 0
+    if buffer is None:
+        for line in stream:
+            if stats is not None:
+                stats.bytes_read += len(line)
+                stats.lines_scanned += 1
+            if regex.search(line, 0, len(line) - line.endswith(b'\n')) if regex is not None \
+                    else pattern.search(line.decode(encoding, 'replace')):
+                count += 1
+                if count == limit:
+                    break
+        return count
+
+    with buffer:
+        size = len(buffer)
+        position = 0
+        while position < size:
+            match = regex.search(buffer, position)
+            if match is None or match.start() == size and buffer[size - 1:size] == b'\n':
+                position = size
+                break
+            end = buffer.find(b'\n', match.start())
+            position = size if end == -1 else end + 1
+            count += 1
+            if count == limit:
+                break
+        if stats is not None:
+            _count_scanned(stats, buffer, position)
+    return count
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a file size like 512, 100K, 10M or 1G.
+
+    :param size: size in bytes with an optional K, M or G suffix
+    :return: the size in bytes
+    """
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper()
+    multiplier = multipliers.get(size[-1:], 1)
+    if multiplier != 1:
+        size = size[:-1]
+    try:
+        return int(size) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: '{size}'") from None
+
+
+def _search_file_for_recursive(filepath: str, pattern: CompiledPattern, count_only: bool, lines_before: int,
+                               lines_after: int, encoding: str, binary_files: str = 'binary',
+                               max_filesize: int = None, show_pattern: bool = False, max_count: int = None,
+                               list_files: str = None, search_compressed: bool = False,
+                               stats: SearchStats = None) -> tuple:
+    """
+    Search one file of a recursive search and return its output lines, runs in the worker processes with -j.
+
+    :param filepath: file to search
+    :param pattern: compiled pattern to search for
+    :param count_only: flag to only return the count of matching
+    :param lines_before: number of lines to include before a match
+    :param lines_after: number of lines to include after a match
+    :param encoding: encoding of the file
+    :param binary_files: what to do with binary files, one of BINARY_FILES_POLICIES (default is 'binary')
+    :param max_filesize: files larger than this number of bytes are skipped (default is None, no limit)
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it (default is False)
+    :param max_count: stop reading the file after this number of matching lines (default is None, read to the end)
+    :param list_files: one of LIST_FILES_MODES to only return the path of the file if it matches or if it does not,
+                       the file is read up to the first match (default is None, return the matching lines)
+    :param search_compressed: flag to decompress gzip, bzip2 and xz files while they are searched (default is False)
+    :param stats: stats to count the searched file in, opening the file and telling binary files apart is read time
+                  and the search itself is match time (default is None)
+    :return: tuple containing the error message (if any) and the list of output lines of the file
+    """
+    started = time.perf_counter() if stats is not None else None
+    try:
+        # the limit applies to the size of the file on disk, also for a compressed file
+        if max_filesize is not None and os.stat(filepath).st_size > max_filesize:
+            return "", []
+        stream = open_input(filepath, search_compressed)
+    except OSError as e:
+        return f"Error reading file '{filepath}': {e}", []
+
+    if list_files:
+        # only whether the file matches is of interest, so the first matching line is enough
+        count_only, lines_before, lines_after, show_pattern, max_count = False, 0, 0, False, 1
+    elif count_only:
+        # only the matching lines are counted
+        lines_before, lines_after, show_pattern = 0, 0, False
+    try:
+        if binary_files != 'text':
+            # binary files are recognised by their first bytes and never decoded
+            sample = stream.read(BINARY_CHECK_SIZE)
+            stream.seek(0)
+            if _looks_binary(sample, encoding):
+                with stream:
+                    if binary_files == 'without-match':
+                        return "", []
+                    if stats is not None:
+                        started = stats.file_opened(started)
+                    count = _count_binary_matches(pattern, stream, encoding,
+                                                  limit=(max_count or 0) if count_only else 1, stats=stats)
+                if stats is not None:
+                    stats.file_searched(started, count)
+                if list_files:
+                    return "", [filepath] if bool(count) == (list_files == 'with-match') else []
+                if not count:
+                    return "", []
+                if count_only:
+                    return "", [f"{filepath}: {count}"]
+                return "", [f"Binary file {filepath} matches"]
+        if stats is not None:
+            started = stats.file_opened(started)
+        result = list(search_pattern_in_file(pattern, stream, pattern.case_insensitive, lines_before, lines_after,
+                                             encoding, show_pattern, max_count,
+                                             None if count_only or list_files else filepath, stats))
+        if stats is not None:
+            # the matching lines are prefixed with 'name: ', the lines around them with 'name- '
+            matches = len(result) if count_only or list_files else \
+                sum(1 for line in result if line.startswith(f"{filepath}: "))
+            stats.file_searched(started, matches)
+    except (UnicodeError, OSError) + DECOMPRESSION_ERRORS as e:
+        # UnicodeError also covers the decoders that reject a whole file, e.g. UTF-16 without a byte order mark
+        return f"Error reading file '{filepath}': {e}", []
+    if list_files:
+        return "", [filepath] if bool(result) == (list_files == 'with-match') else []
+    if not result:
+        return "", []
+    if count_only:
+        return "", [f"{filepath}: {len(result)}"]
+    return "", result
 
 
-def search_pattern_in_strings(search_pattern: str, array_of_strings: list, case_insensitive: bool = False,
-                              lines_before: int = 0, lines_after: int = 0) -> list:
+def _closing_index(search_pattern: str, start: int) -> int:
     """
-    Search a pattern from list of strings and return the matching lines.
+    Find the end of the group or character class that starts at an index of a regular expression.
+
+    :param search_pattern: regular expression
+    :param start: index of the opening '(' or '['
+    :return: index of the closing ')' or ']' or -1 if it is not closed
+    """
+    i = start + 1
+    if search_pattern[start] == '[':
+        if search_pattern[i:i + 1] == '^':
+            i += 1
+        if search_pattern[i:i + 1] == ']':
+            i += 1
+        while i < len(search_pattern):
+            if search_pattern[i] == '\\':
+                i += 1
+            elif search_pattern[i] == ']':
+                return i
+            i += 1
+        return -1
+    depth = 1
+    while i < len(search_pattern):
+        char = search_pattern[i]
+        if char == '\\':
+            i += 1
+        elif char == '[':
+            i = _closing_index(search_pattern, i)
+            if i == -1:
+                return -1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return -1
+
+
+def _escape_end(search_pattern: str, start: int) -> int:
+    """
+    Find the last character of an escape sequence of a regular expression, e.g. of '\\x41' or '\\N{DASH}'.
+
+    :param search_pattern: regular expression
+    :param start: index of the character after the backslash
+    :return: index of the last character of the escape sequence
+    """
+    char = search_pattern[start]
+    if char in 'xuU':
+        return min(start + {'x': 2, 'u': 4, 'U': 8}[char], len(search_pattern) - 1)
+    if char == 'N' and search_pattern[start + 1:start + 2] == '{':
+        end = search_pattern.find('}', start)
+        return len(search_pattern) - 1 if end == -1 else end
+    if char.isdigit():
+        # octal escapes have up to three digits, backreferences up to two
+        digits = re.match(r'\d{1,3}', search_pattern[start:]).group()
+        return start + len(digits) - 1
+    return start
+
+
+def _required_runs(search_pattern: str) -> list:
+    """
+    Find the runs of plain text that every match of a regular expression contains, e.g. 'foo' and 'bar' in
+    'foo\\d+bar'. Groups, character classes and optional atoms are left out.
+
+    :param search_pattern: regular expression
+    :return: list of the required text runs, empty if the pattern has an alternation at the top level
+    """
+    runs = []
+    run = []
+    i = 0
+    while i < len(search_pattern):
+        char = search_pattern[i]
+        if char == '|':
+            return []
+        if char == '\\' and i + 1 < len(search_pattern):
+            i += 1
+            if search_pattern[i].isalnum():
+                # a class, an anchor, a numeric escape or a backreference, the text it matches is not known here
+                runs.append(''.join(run))
+                run = []
+                i = _escape_end(search_pattern, i)
+            else:
+                run.append(search_pattern[i])
+        elif char in '([':
+            i = _closing_index(search_pattern, i)
+            if i == -1:
+                return []
+            runs.append(''.join(run))
+            run = []
+        elif char == '{' and not re.match(r'\{\d*(,\d*)?\}', search_pattern[i:]):
+            # not a repetition, a plain brace
+            run.append(char)
+        elif char in '*?{':
+            # the atom before the quantifier may not be there at all
+            if char == '{':
+                i = search_pattern.index('}', i)
+            if run:
+                run.pop()
+            runs.append(''.join(run))
+            run = []
+        elif char in '+.^$':
+            runs.append(''.join(run))
+            run = []
+        else:
+            run.append(char)
+        i += 1
+    runs.append(''.join(run))
+    return [run for run in runs if run]
+
+
+def pattern_trigrams(search_pattern: str, case_insensitive: bool = False):
+    """
+    Work out the trigrams a line must contain to match a pattern, in the lowercase form they are indexed in.
 
     :param search_pattern: pattern to search for
-    :param array_of_strings: list of strings to search from
     :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
-    :param lines_before: number of lines to include before a match (default is 0)
-    :param lines_after: number of lines to include after a match (default is 0)
-    :return: list of matching lines
+    :return: set of trigrams as bytes or None if the pattern does not require any trigram
+    """
+    literal = _literal_text(search_pattern)
+    if literal is None:
+        inline_flags = set(''.join(re.findall(r'\(\?([a-zA-Z-]+)[:)]', search_pattern)))
+        if inline_flags - {'i', '-'}:
+            # e.g. verbose mode, the text of the pattern is not the text it matches
+            return None
+        # inline flags may make the pattern case-insensitive
+        case_insensitive = case_insensitive or 'i' in inline_flags
+    runs = [literal] if literal is not None else _required_runs(search_pattern)
+    # non-ASCII characters depend on the encoding of the files and some ASCII letters also match non-ASCII letters
+    # case-insensitively, the runs are split at them
+    breaks = re.compile('[^\\x00-\\x7f]|[iksIKS]' if case_insensitive else '[^\\x00-\\x7f]')
+    trigrams = set()
+    for run in runs:
+        for part in breaks.split(run):
+            data = part.encode('ascii').lower()
+            trigrams.update(data[i:i + 3] for i in range(len(data) - 2))
+    return trigrams or None
+
+
+class TrigramIndex:
+    """
+    On-disk trigram index of the files of a directory, stored in an SQLite database in the directory.
+
+    Every file has a posting for each distinct trigram of its lowercased bytes. A search looks up the trigrams its
+    pattern requires and only the files that have all of them, or changed since they were indexed, are read.
     """
-    if not array_of_strings:
-        return "", []
 
-    # list to store the matching lines
-    matches = []
+    def __init__(self, directory: str, create: bool = False):
+        """
+        :param directory: indexed directory
+        :param create: flag to create the index if it does not exist (default is False)
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_FILE_NAME)
+        if not create and not os.path.isfile(self.path):
+            raise FileNotFoundError(f"No index found in directory '{directory}'.")
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL,
+                indexed INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                trigram BLOB NOT NULL, file_id INTEGER NOT NULL, PRIMARY KEY (trigram, file_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_file_id ON postings (file_id);
+        ''')
 
-    for i, line in enumerate(array_of_strings):
-        if re.search(search_pattern, line, re.IGNORECASE if case_insensitive else 0):
-            # line matches the search pattern
+    def close(self):
+        self.connection.close()
 
-            # add lines before the match
-            start = max(i - lines_before, 0)
-            matches.extend(array_of_strings[start:i])
+    def __enter__(self):
+        return self
 
-            # add the matched line
-            matches.append(line.strip())
+    def __exit__(self, *exc_info):
+        self.close()
 
-            # add lines after the match
-            end = min(i + lines_after + 1, len(array_of_strings))
-            matches.extend(array_of_strings[i + 1:end])
-    matches = [s.strip("\n") for s in matches]
-    return "", matches
+    def _relative_path(self, filepath: str) -> str:
+        return os.path.relpath(filepath, self.directory)
 
+    def _files(self) -> dict:
+        rows = self.connection.execute('SELECT path, id, mtime_ns, size, indexed FROM files')
+        return {path: (file_id, mtime_ns, size, indexed) for path, file_id, mtime_ns, size, indexed in rows}
 
-def search_files_recursive(directory: str, search_pattern: str, case_insensitive: bool = False,
-                           count_only: bool = False, lines_before: int = 0, lines_after: int = 0) -> tuple:
+    def update(self, path_filter=None, max_filesize: int = INDEX_MAX_FILESIZE) -> tuple:
+        """
+        Bring the index up to date, only the files whose modification time or size changed are read again.
+
+        :param path_filter: filter deciding which files and directories are indexed (default is None, all of them)
+        :param max_filesize: files larger than this number of bytes are not indexed and always searched
+        :return: tuple with the number of indexed, updated and removed files
+        """
+        known = self._files()
+        seen = set()
+        updated = 0
+        with self.connection:
+            for filepath in _walk_files(self.directory, path_filter):
+                path = self._relative_path(filepath)
+                try:
+                    file_stat = os.stat(filepath)
+                except OSError:
+                    continue
+                seen.add(path)
+                entry = known.get(path)
+                if entry is not None and entry[1:3] == (file_stat.st_mtime_ns, file_stat.st_size):
+                    continue
+                trigrams = None
+                if file_stat.st_size <= max_filesize:
+                    try:
+                        trigrams = _file_trigrams(filepath)
+                    except OSError:
+                        pass
+                if entry is not None:
+                    file_id = entry[0]
+                    self.connection.execute('DELETE FROM postings WHERE file_id = ?', (file_id,))
+                    self.connection.execute('UPDATE files SET mtime_ns = ?, size = ?, indexed = ? WHERE id = ?',
+                                            (file_stat.st_mtime_ns, file_stat.st_size, trigrams is not None, file_id))
+                else:
+                    file_id = self.connection.execute(
+                        'INSERT INTO files (path, mtime_ns, size, indexed) VALUES (?, ?, ?, ?)',
+                        (path, file_stat.st_mtime_ns, file_stat.st_size, trigrams is not None)).lastrowid
+                if trigrams:
+                    self.connection.executemany('INSERT INTO postings (trigram, file_id) VALUES (?, ?)',
+                                                ((trigram, file_id) for trigram in trigrams))
+                updated += 1
+            removed = [entry[0] for path, entry in known.items() if path not in seen]
+            for file_id in removed:
+                self.connection.execute('DELETE FROM postings WHERE file_id = ?', (file_id,))
+                self.connection.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        return len(seen), updated, len(removed)
+
+    def _files_with_trigrams(self, trigrams: set) -> set:
+        """
+        :param trigrams: set of trigrams
+        :return: set of the ids of the files that have all the trigrams
+        """
+        file_ids = None
+        for trigram in trigrams:
+            rows = self.connection.execute('SELECT file_id FROM postings WHERE trigram = ?', (trigram,))
+            file_ids = {row[0] for row in rows} if file_ids is None else file_ids & {row[0] for row in rows}
+            if not file_ids:
+                break
+        return file_ids
+
+    def filter(self, filepaths, search_pattern, case_insensitive: bool = False, encoding: str = 'utf-8'):
+        """
+        Leave out the files the index proves can not match a pattern.
+
+        :param filepaths: iterable of the paths of the files in the indexed directory
+        :param search_pattern: pattern to search for, a string, a list of patterns or a CompiledPattern
+        :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+        :param encoding: encoding the files are searched in, the indexed bytes only prove anything for encodings
+                         that store ASCII text as ASCII bytes (default is 'utf-8')
+        :return: generator of the paths of the files that have to be searched
+        """
+        pattern = compile_pattern(search_pattern, case_insensitive)
+        trigram_sets = [pattern_trigrams(pattern_text, pattern.case_insensitive) for pattern_text in pattern.patterns]
+        if any(trigrams is None for trigrams in trigram_sets) or not _is_ascii_compatible(encoding):
+            yield from filepaths
+            return
+
+        # a file may match if it has all the trigrams of any of the patterns
+        candidates = set()
+        for trigrams in trigram_sets:
+            candidates |= self._files_with_trigrams(trigrams)
+        known = self._files()
+        for filepath in filepaths:
+            entry = known.get(self._relative_path(filepath))
+            if entry is not None and entry[0] not in candidates and entry[3]:
+                try:
+                    file_stat = os.stat(filepath)
+                except OSError:
+                    continue
+                if entry[1:3] == (file_stat.st_mtime_ns, file_stat.st_size):
+                    # indexed, unchanged and without all the trigrams of the pattern
+                    continue
+            yield filepath
+
+
+def _file_trigrams(filepath: str) -> set:
+    """
+    Read the distinct trigrams of a file.
+
+    :param filepath: file to read
+    :return: set of the trigrams of the lowercased bytes of the file or None for a compressed file, its text is not
+             in its bytes
+    """
+    trigrams = set()
+    with open(filepath, 'rb') as file:
+        if _compression_module(file) is not None:
+            return None
+        tail = b''
+        while True:
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            # the last two bytes of a chunk start trigrams that end in the next one
+            data = tail + chunk.lower()
+            trigrams.update(data[i:i + 3] for i in range(len(data) - 2))
+            tail = data[-2:]
+    return trigrams
+
+
+def build_index(directory: str, path_filter=None, max_filesize: int = None) -> tuple:
+    """
+    Build or update the trigram index of a directory.
+
+    :param directory: directory to index
+    :param path_filter: filter deciding which files and directories are indexed (default is None, all of them)
+    :param max_filesize: files larger than this number of bytes are not indexed (default is INDEX_MAX_FILESIZE)
+    :return: tuple containing the error message (if any) and the list of output lines
+    """
+    if not os.path.isdir(directory):
+        return f"Directory '{directory}' not found.", []
+    with TrigramIndex(directory, create=True) as index:
+        files, updated, removed = index.update(path_filter, max_filesize or INDEX_MAX_FILESIZE)
+    return "", [f"Indexed {files} files in '{directory}', {updated} updated and {removed} removed."]
+
+
+def search_files_recursive(directory: str, search_pattern, case_insensitive: bool = False,
+                           count_only: bool = False, lines_before: int = 0, lines_after: int = 0,
+                           jobs: int = 1, binary_files: str = 'binary', max_filesize: int = None,
+                           path_filter: PathFilter = None, use_index: bool = False,
+                           show_pattern: bool = False, max_count: int = None, list_files: str = None,
+                           quiet: bool = False, encoding: str = 'utf-8', search_compressed: bool = False,
+                           stats: SearchStats = None) -> tuple:
     """
     Recursively search files in a directory for a pattern and return the matched lines along with its file name.
 
+    A file that can not be read is reported on STDERR and the search goes on with the next file.
+
     :param directory: directory to search in
-    :param search_pattern: pattern to search for
+    :param search_pattern: pattern to search for, a string or a CompiledPattern
     :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
     :param count_only: flag to only return the count of matching (default is False)
     :param lines_before: number of lines to include before a match (default is 0)
     :param lines_after: number of lines to include after a match (default is 0)
-    :return: tuple containing the error message (if any) and the list of matching lines
+    :param jobs: number of worker processes searching files, 0 uses one per CPU (default is 1, search in this process)
+    :param binary_files: what to do with binary files, one of BINARY_FILES_POLICIES (default is 'binary', report
+                         that they match)
+    :param max_filesize: files larger than this number of bytes are skipped (default is None, no limit)
+    :param path_filter: filter deciding which files and directories are skipped (default is None, nothing is skipped)
+    :param use_index: flag to skip the files the trigram index of the directory proves can not match (default is
+                      False)
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it (default is False)
+    :param max_count: stop reading a file after this number of matching lines (default is None, read to the end)
+    :param list_files: one of LIST_FILES_MODES to only list the files that match or the files that do not (default
+                       is None, list the matching lines)
+    :param quiet: flag to stop the whole search at the first file with any output (default is False)
+    :param encoding: encoding of the files (default is 'utf-8')
+    :param search_compressed: flag to decompress gzip, bzip2 and xz files while they are searched, with jobs the
+                              files are decompressed in the worker processes (default is False)
+    :param stats: stats to count the files, bytes, lines and matches and the time of every phase in, they are
+                  complete once the matching lines are exhausted (default is None)
+    :return: tuple containing the error message (if any) and the matching lines, which are produced while the
+             files are searched
     """
     if not os.path.isdir(directory):
         return f"Directory '{directory}' not found.", []
 
-    files_found = False  # Flag to check if any files are found in the directory or its subdirectories
+    pattern = compile_pattern(search_pattern, case_insensitive)
+
+    filepaths = _walk_files(directory, path_filter, stats)
+    if stats is not None:
+        filepaths = stats.timed(filepaths, 'walk')
+    first_filepath = next(filepaths, None)
+    if first_filepath is None:
+        return f"No files found in directory '{directory}'.", []
+    filepaths = itertools.chain([first_filepath], filepaths)
+
+    if use_index:
+        try:
+            index = TrigramIndex(directory)
+        except FileNotFoundError as err:
+            return f"{err} Build it with 'index {directory}'.", []
+        if list_files != 'without-match':
+            filepaths = index.filter(filepaths, pattern, encoding=encoding)
+        error_message, lines = _search_files(filepaths, pattern, count_only, lines_before, lines_after, jobs,
+                                             encoding, binary_files, max_filesize, show_pattern, max_count,
+                                             list_files, quiet, search_compressed, stats)
+        return error_message, _closing(index, lines)
+    return _search_files(filepaths, pattern, count_only, lines_before, lines_after, jobs, encoding, binary_files,
+                         max_filesize, show_pattern, max_count, list_files, quiet, search_compressed, stats)
+
+
+def _search_files(filepaths, pattern: CompiledPattern, count_only: bool, lines_before: int, lines_after: int,
+                  jobs: int, encoding: str, binary_files: str, max_filesize: int, show_pattern: bool,
+                  max_count: int = None, list_files: str = None, quiet: bool = False,
+                  search_compressed: bool = False, stats: SearchStats = None) -> tuple:
+    """
+    Search the files of a recursive search, in this process or in worker processes.
+
+    :param filepaths: iterable of the paths of the files to search
+    :param pattern: compiled pattern to search for
+    :param count_only: flag to only return the count of matching
+    :param lines_before: number of lines to include before a match
+    :param lines_after: number of lines to include after a match
+    :param jobs: number of worker processes searching files, 0 uses one per CPU
+    :param encoding: encoding of the files
+    :param binary_files: what to do with binary files, one of BINARY_FILES_POLICIES
+    :param max_filesize: files larger than this number of bytes are skipped, None for no limit
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it
+    :param max_count: stop reading a file after this number of matching lines, None to read to the end
+    :param list_files: one of LIST_FILES_MODES to only list the files that match or the files that do not, None to
+                       list the matching lines
+    :param quiet: flag to stop the whole search at the first file with any output
+    :param search_compressed: flag to decompress gzip, bzip2 and xz files while they are searched
+    :param stats: stats to count the searched files in, None to not count them
+    :return: tuple containing the error message (if any) and the generator of matching lines
+    """
+    search_file = functools.partial(_search_file_for_recursive, pattern=pattern, count_only=count_only,
+                                    lines_before=lines_before, lines_after=lines_after, encoding=encoding,
+                                    binary_files=binary_files, max_filesize=max_filesize,
+                                    show_pattern=show_pattern, max_count=max_count, list_files=list_files,
+                                    search_compressed=search_compressed, stats=stats)
+    # the groups of lines around the matches of different files are separated like the groups within a file
+    separate_files = bool(lines_before or lines_after) and not count_only and not list_files
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        results = map(search_file, filepaths)
+    else:
+        # this process walks the directories while the workers search the files, the results are put back together
+        # in the order of the walk so the output does not depend on which worker finishes first
+        if stats is not None:
+            # every worker counts in its own stats, they are added to these ones with the results of every chunk
+            search_file = functools.partial(search_file, stats=SearchStats())
+        results = _map_in_workers(search_file, filepaths, jobs, RECURSIVE_CHUNK_SIZE, stats)
+    return "", _collect_file_results(results, quiet, separate_files)
+
+
+# function searching one file in a worker process, set once per worker by _init_worker
+_worker_search_file = None
+
+
+def _init_worker(search_file):
+    # the pattern is passed to every worker once instead of with every chunk, where it would be compiled again
+    global _worker_search_file
+    _worker_search_file = search_file
+
+
+def _search_chunk(filepaths: list) -> tuple:
+    results = [_worker_search_file(filepath) for filepath in filepaths]
+    stats = _worker_search_file.keywords.get('stats')
+    return results, stats.take() if stats is not None else None
+
+
+def _map_in_workers(search_file, filepaths, jobs: int, chunksize: int, stats: SearchStats = None):
+    """
+    Search files in worker processes like executor.map, but only hand out a few chunks of files ahead.
+
+    executor.map takes every file of the walk up front, here the walk goes on only as fast as the workers search, so
+    a search that stops early neither walks the rest of the directory nor waits for files nobody asked for. The
+    workers are shut down once the generator is exhausted or closed.
+
+    :param search_file: function searching one file, must be picklable, it is handed to each worker once
+    :param filepaths: iterable of the paths of the files to search
+    :param jobs: number of worker processes
+    :param chunksize: number of files handed to a worker at once
+    :param stats: stats to add the stats of the workers to, they are collected by the `stats` keyword argument of
+                  search_file (default is None)
+    :return: generator of the results of search_file in the order of filepaths
+    """
+    filepaths = iter(filepaths)
+    chunks = iter(lambda: list(itertools.islice(filepaths, chunksize)), [])
+    pending = deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                initargs=(search_file,)) as executor:
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(_search_chunk, chunk))
+                if len(pending) >= 2 * jobs:
+                    yield from _chunk_results(pending.popleft(), stats)
+            while pending:
+                yield from _chunk_results(pending.popleft(), stats)
+        finally:
+            # the chunks that were handed out but are not needed any more
+            for future in pending:
+                future.cancel()
+
+
+def _chunk_results(future, stats: SearchStats = None) -> list:
+    results, chunk_stats = future.result()
+    if stats is not None and chunk_stats is not None:
+        stats.add(chunk_stats)
+    return results
 
-    matches = []
 
-    for root, dirs, files in os.walk(directory):
-        if not files and not dirs:
-            # Directory is empty
+def _closing(resource, lines):
+    """
+    Yield lines and close a resource they are read from once they are exhausted or the generator is closed.
+
+    :param resource: object with a close method, e.g. a TrigramIndex
+    :param lines: iterable of lines
+    :return: generator of the lines
+    """
+    try:
+        yield from lines
+    finally:
+        resource.close()
+
+
+def _collect_file_results(results, quiet: bool = False, separate_files: bool = False):
+    """
+    Put the output lines of the searched files together, errors of single files are reported on STDERR.
+
+    :param results: iterable of (error message, output lines) tuples of the searched files
+    :param quiet: flag to stop at the first file with any output, errors are not reported then (default is False)
+    :param separate_files: flag to put GROUP_SEPARATOR between the output lines of two files (default is False)
+    :return: generator of output lines
+    """
+    any_output = False
+    for error_message, output_lines in results:
+        if error_message and not quiet:
+            print(error_message, file=sys.stderr)
+        if not output_lines:
             continue
-        for file in files:
-            filepath = os.path.join(root, file)
-            if os.path.isfile(filepath):
-                files_found = True
-                try:
-                    with open(filepath, 'r') as file_content:
-                        result = search_pattern_in_strings(search_pattern, file_content.readlines(), case_insensitive,
-                                                           lines_before, lines_after)
-                        if result[1]:
-                            if count_only:
-                                matches.append(f"{filepath}: {len(result[1])}")
-                            else:
-                                if lines_before:
-                                    matches.append(f"{filepath}: {''.join(result[1][:lines_before])}")
-                                matches.append(f"{filepath}: {''.join(result[1][lines_after:])}")
-                except UnicodeDecodeError as e:
-                    return f"Error reading file '{filepath}': {e}", []
-    if not files_found:
-        return f"No files found in directory '{directory}'.", []
-    return "", matches
+        if separate_files and any_output:
+            yield GROUP_SEPARATOR
+        yield from output_lines
+        if quiet:
+            return
+        any_output = True
+
+
+class OutputSink:
+    """
+    Write output lines to a binary stream in large batches instead of one write per line.
+
+    The lines are collected until WRITE_BUFFER_SIZE bytes are pending and then encoded and written at once. In line
+    buffered mode, e.g. when the output is a terminal, every line is written as soon as it is given.
+    """
+
+    def __init__(self, stream, encoding: str = 'utf-8', errors: str = 'strict', line_buffered: bool = False,
+                 stats: SearchStats = None):
+        """
+        :param stream: binary stream to write to, e.g. sys.stdout.buffer or a file opened with 'wb'
+        :param encoding: encoding of the output (default is 'utf-8')
+        :param errors: how characters that can not be encoded are handled, see str.encode (default is 'strict')
+        :param line_buffered: flag to write every line at once (default is False, write in batches)
+        :param stats: stats to add the time spent encoding and writing to as output time (default is None)
+        """
+        self.stream = stream
+        self.encoding = encoding
+        self.errors = errors
+        self.line_buffered = line_buffered
+        self.stats = stats
+        self.lines_written = 0
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, line: str):
+        """
+        Write one output line, the line break is added.
+
+        :param line: line to write
+        """
+        self._pending.append(line)
+        self._pending_size += len(line) + 1
+        self.lines_written += 1
+        if self.line_buffered or self._pending_size >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def write_lines(self, lines) -> int:
+        """
+        Write output lines as they are produced.
+
+        :param lines: iterable of lines to write
+        :return: the number of lines written
+        """
+        written = self.lines_written
+        for line in lines:
+            self.write(line)
+        return self.lines_written - written
+
+    def flush(self):
+        """
+        Write the pending lines to the stream and flush it.
+        """
+        started = time.perf_counter() if self.stats is not None else None
+        if self._pending:
+            self._pending.append('')
+            data = '\n'.join(self._pending).encode(self.encoding, self.errors)
+            self._pending = []
+            self._pending_size = 0
+            self.stream.write(data)
+        self.stream.flush()
+        if self.stats is not None:
+            self.stats.times['output'] += time.perf_counter() - started
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        # after a failed write, e.g. to a closed pipe, writing the rest would only fail again
+        if exc_type is None:
+            self.flush()
 
-def my_grep(search_pattern: str, filename: str = None, output_file_path: str = None, case_insensitive: bool = False,
+
+def my_grep(search_pattern, filename: str = None, output_file_path: str = None, case_insensitive: bool = False,
             count_only: bool = False, lines_before: int = 0, lines_after: int = 0,
-            recursive: bool = False) -> tuple:
+            recursive: bool = False, jobs: int = 1, binary_files: str = 'binary', max_filesize: int = None,
+            include: list = None, exclude: list = None, exclude_dir: list = None, ignore_files: bool = False,
+            use_index: bool = False, show_pattern: bool = False, max_count: int = None, list_files: str = None,
+            quiet: bool = False, encoding: str = 'utf-8', search_compressed: bool = False,
+            stats: SearchStats = None, follow: bool = False) -> tuple:
     """
     Search provided string/pattern in file/STDIN/directory and return the matches
 
@@ -102,12 +2326,73 @@ def my_grep(search_pattern: str, filename: str = None, output_file_path: str = N
     :param count_only:
     :param lines_before:
     :param lines_after:
-    :return: tuple containing the error message (if any) and the list of matching lines
+    :param jobs:
+    :param binary_files:
+    :param max_filesize:
+    :param include:
+    :param exclude:
+    :param exclude_dir:
+    :param ignore_files:
+    :param use_index:
+    :param show_pattern:
+    :param max_count:
+    :param list_files:
+    :param quiet:
+    :param encoding:
+    :param search_compressed:
+    :param stats:
+    :param follow:
+    :return: tuple containing the error message (if any) and the matching lines, which are produced while the input
+             is read
     """
-    # search_string = re.compile(search_string)
+    # the pattern is compiled once and shared by every search path
+    try:
+        pattern = compile_pattern(search_pattern, case_insensitive)
+    except re.error as err:
+        return f"Invalid pattern {_quote_patterns(search_pattern)}: {err}", []
+    except ValueError as err:
+        return f"{err}", []
+    error_message = _encoding_error(encoding)
+    if error_message:
+        return error_message, []
+    if quiet or list_files:
+        # only whether anything matches is of interest, the search stops at the first match
+        max_count, count_only, lines_before, lines_after, show_pattern = 1, False, 0, 0, False
+    elif count_only:
+        # only the matching lines are counted
+        lines_before, lines_after, show_pattern = 0, 0, False
+    if follow and filename:
+        # the file, or every file of the directory, is searched and then followed until interrupted
+        if recursive:
+            if not os.path.isdir(filename):
+                return f"Directory '{filename}' not found.", []
+            path_filter = None
+            if include or exclude or exclude_dir or ignore_files:
+                path_filter = PathFilter(include, exclude, exclude_dir, ignore_files)
+            filepaths = list(_followed_files(filename, path_filter, binary_files, max_filesize, encoding, stats))
+            if not filepaths:
+                return f"No files found in directory '{filename}'.", []
+        else:
+            filepaths = [filename]
+            if not os.path.exists(filename):
+                return f"File '{filename}' not found.", []
+            if not os.access(filename, os.R_OK):
+                return f"No read permission for file '{filename}'.", []
+            if os.path.isdir(filename):
+                return f"'{filename}' is a directory, follow its files with -r.", []
+            if stats is not None:
+                stats.files_walked += 1
+        return "", follow_files(pattern, filepaths, case_insensitive, lines_before, lines_after, encoding,
+                                show_pattern, max_count, recursive, stats)
     if recursive and filename:
-        return search_files_recursive(filename, search_pattern, case_insensitive, count_only, lines_before,
-                                      lines_after)
+        path_filter = None
+        if include or exclude or exclude_dir or ignore_files:
+            path_filter = PathFilter(include, exclude, exclude_dir, ignore_files)
+        return search_files_recursive(filename, pattern, case_insensitive, count_only, lines_before, lines_after,
+                                      jobs, binary_files, max_filesize, path_filter, use_index, show_pattern,
+                                      max_count, list_files, quiet, encoding, search_compressed, stats)
+    # with stats the lines are prefixed like in a recursive search to tell the matches from the lines around them
+    prefix = '' if stats is not None else None
     if filename:
         # filepath is variable which has the value for filename relative path
         filepath = os.path.join(os.getcwd(), filename)
@@ -117,51 +2402,944 @@ def my_grep(search_pattern: str, filename: str = None, output_file_path: str = N
         # checks weather file has the read access or not
         if not os.access(filepath, os.R_OK):
             return f"No read permission for file '{filename}'.", []
-        stream = []
+        started = time.perf_counter() if stats is not None else None
         try:
-            # open a file and iterate through line by line to check weather the provided string exists in the line or
-            # not
-            stream = codecs.open(filepath, 'r', encoding='utf-8')
+            # open the file, its lines are read in chunks while the search runs instead of all at once
+            stream = open_input(filepath, search_compressed)
         except IsADirectoryError as err:
             return f'{err}', []
-        except UnicodeDecodeError as e:
-            return f"Error decoding file '{filepath}' with encoding 'utf-8'", []
+        if stats is not None:
+            stats.files_walked += 1
+            stats.file_opened(started)
+        matches = search_pattern_in_file(pattern, stream, case_insensitive, lines_before, lines_after, encoding,
+                                         show_pattern, max_count, prefix, stats)
     else:
-        stream = sys.stdin
-    if stream:
-        result = search_pattern_in_strings(search_pattern, stream.readlines(), case_insensitive, lines_before,
-                                           lines_after)
-    else:
-        result = []
+        try:
+            # STDIN is read as bytes like a file, closing this stream leaves STDIN itself open
+            stream = open(sys.stdin.fileno(), 'rb', buffering=READ_CHUNK_SIZE, closefd=False)
+        except (AttributeError, OSError, ValueError):
+            # STDIN was replaced by a stream without a file descriptor
+            stream = None
+        if stream is not None and search_compressed:
+            module = _compression_module(stream)
+            if module is not None:
+                stream = module.open(stream, 'rb')
+        if stream is not None:
+            matches = search_pattern_in_file(pattern, stream, case_insensitive, lines_before, lines_after, encoding,
+                                             show_pattern, max_count, prefix, stats)
+        else:
+            # the bytes behind a stream of text are unknown, only its lines are counted
+            lines = sys.stdin if stats is None else _counted_lines(sys.stdin, stats)
+            matches = search_pattern_in_stream(pattern, lines, case_insensitive, lines_before, lines_after,
+                                               show_pattern, max_count, prefix)
+    if stats is not None:
+        matches = _instrumented_lines(matches, stats)
 
-    if output_file_path and result[1]:
+    # look at the first match, nothing is written or reported when there is none
+    try:
+        first_match = next(matches, None)
+    except (OSError, UnicodeError) + DECOMPRESSION_ERRORS as err:
+        return f"Error reading file '{filename or '(standard input)'}': {err}", []
+    if list_files:
+        matches.close()
+        if (first_match is not None) != (list_files == 'with-match'):
+            return "", []
+        # the closed search yields no more lines, the name of the file takes the place of the first match
+        first_match = filename or '(standard input)'
+    if first_match is None:
+        return "", []
+    result = itertools.chain([first_match], matches)
+    if quiet:
+        matches.close()
+        return "", [first_match]
+
+    if output_file_path:
         if os.path.exists(os.path.join(os.getcwd(), output_file_path)):
+            matches.close()
             return f"Output file '{output_file_path}' already exists.", []
-        with open(os.path.join(os.getcwd(), output_file_path), 'w') as output_file_content:
+        encoding = locale.getpreferredencoding(False)
+        # the matching lines are printed as well, they are read back from a file instead of being kept in memory
+        spool = tempfile.TemporaryFile() if count_only else None
+        with open(os.path.join(os.getcwd(), output_file_path), 'wb') as output_file_content:
             if count_only:
-                output_file_content.write(str(len(result[1])) + '\n')
+                with OutputSink(spool, encoding) as sink:
+                    count = sink.write_lines(result)
+                with OutputSink(output_file_content, encoding, stats=stats) as sink:
+                    sink.write(str(count))
+            else:
+                with OutputSink(output_file_content, encoding, stats=stats) as sink:
+                    sink.write_lines(result)
+        return "", _read_lines(spool or open(os.path.join(os.getcwd(), output_file_path), 'rb'), encoding)
+
+    if list_files:
+        return "", [first_match]
+
+    if count_only:
+        return "", [sum(1 for _ in result)]
+
+    return "", _found_message(result, search_pattern)
+
+
+def _read_lines(stream, encoding: str):
+    """
+    Read back the lines written by an OutputSink and close the stream.
+
+    :param stream: binary stream the lines were written to
+    :param encoding: encoding of the lines
+    :return: generator of the lines without their line breaks
+    """
+    with stream:
+        stream.seek(0)
+        for line in stream:
+            yield line[:-1].decode(encoding) if line.endswith(b'\n') else line.decode(encoding)
+
+
+def read_patterns(pattern_file: str) -> list:
+    """
+    Read the patterns of a pattern file, one pattern per line.
+
+    :param pattern_file: path of the pattern file
+    :return: list of patterns
+    """
+    with open(pattern_file, 'r') as patterns:
+        return patterns.read().splitlines()
+
+
+def _quote_patterns(search_pattern) -> str:
+    """
+    Quote a pattern or a list of patterns for a message.
+
+    :param search_pattern: pattern or list of patterns
+    :return: the quoted patterns separated by commas, long lists are cut short
+    """
+    patterns = [search_pattern] if isinstance(search_pattern, str) else search_pattern
+    quoted = ', '.join(f"'{pattern}'" for pattern in patterns[:QUOTED_PATTERNS])
+    if len(patterns) > QUOTED_PATTERNS:
+        quoted += f" and {len(patterns) - QUOTED_PATTERNS} more"
+    return quoted
+
+
+def _found_message(lines, search_pattern):
+    """
+    Yield the matching lines followed by the message reporting the match.
+
+    :param lines: iterable of matching lines, must not be empty
+    :param search_pattern: pattern or list of patterns that was searched for
+    :return: generator of output lines
+    """
+    yield from lines
+    yield f"I found {_quote_patterns(search_pattern)} in the file."
+
+
+class _Inotify:
+    """
+    Wait for changes in directories with the inotify API of Linux.
+
+    Directories are watched instead of files, so a followed file that is replaced by a new one, e.g. when a log is
+    rotated, is noticed as well.
+    """
+
+    def __init__(self):
+        """
+        :raises OSError: if inotify is not available
+        """
+        if ctypes is None or not sys.platform.startswith('linux'):
+            raise OSError("inotify is not available on this platform")
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories = {}  # watch descriptor -> directories
+
+    def watch(self, directory: str):
+        """
+        Watch a directory for changes of the files in it.
+
+        :param directory: directory to watch
+        :raises OSError: if the directory can not be watched, e.g. when the limit of watches is reached
+        """
+        descriptor = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_EVENTS)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+        self._directories.setdefault(descriptor, set()).add(directory)
+
+    def wait(self, timeout: float):
+        """
+        Wait until files in the watched directories change.
+
+        :param timeout: seconds to wait at most
+        :return: set of the (directory, name) tuples of the changed files, or None if nothing is known about the
+                 changes, i.e. after the timeout or when events were lost
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        try:
+            data = os.read(self.fd, READ_CHUNK_SIZE)
+        except BlockingIOError:
+            return None
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, _, _, length = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if descriptor not in self._directories:
+                # the queue overflowed and events were dropped
+                return None
+            changed.update((directory, name) for directory in self._directories[descriptor])
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _FollowedFile:
+    """
+    A file searched by follow_files, it is kept open and only the bytes appended since it was read last are searched.
+    """
+
+    def __init__(self, path: str, pattern: CompiledPattern, window: _ContextWindow, encoding: str,
+                 label: str = None, stats: SearchStats = None):
+        """
+        :param path: path of the file
+        :param pattern: compiled pattern to search for
+        :param window: context window of the file, it keeps the lines around matches between reads
+        :param encoding: encoding of the file
+        :param label: name to prefix the lines with, see _format_lines (default is None, no prefix)
+        :param stats: stats to count the bytes, lines and matches in (default is None)
+        """
+        self.path = path
+        self.directory, self.name = os.path.split(path)
+        self.directory = self.directory or os.curdir
+        self.pattern = pattern
+        self.regex = pattern.bytes_regex_for(encoding)
+        self.window = window
+        self.encoding = encoding
+        self.label = label
+        self.stats = stats
+        self.stream = None
+        self.identity = None  # (device, inode) of the open file
+        self.offset = 0  # number of bytes read from the open file
+        self.number = 0  # number of the next line
+        self.rest = None  # start of a line whose end was not written yet
+        self.decoder = None
+
+    def open(self):
+        """
+        Open the file and search it from its start.
+
+        :raises OSError: if the file can not be opened
+        """
+        stream = open(self.path, 'rb', buffering=0)
+        file_stat = os.fstat(stream.fileno())
+        if self.stats is not None and self.identity is None:
+            # a file that replaces a rotated one is counted once with it
+            self.stats.files_searched += 1
+        self.stream, self.identity, self.offset = stream, (file_stat.st_dev, file_stat.st_ino), 0
+        if self.regex is None:
+            # the pattern needs text, an incremental decoder keeps multibyte characters cut by a read together
+            self.decoder = codecs.getincrementaldecoder(self.encoding)(DECODE_ERRORS)
+            self.rest = ''
+        else:
+            self.rest = b''
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def search(self):
+        """
+        Search what was appended to the file since the last search.
+
+        A file that shrank below the read offset was truncated and is searched again from its start. When the path
+        names another file than the open one, the file was rotated: the rest of the old file is searched and the
+        new one is followed from its start. A file that was removed and not created again yet is waited for.
+
+        :return: generator of output lines
+        :raises OSError: if the file can not be read
+        """
+        if self.stream is None:
+            try:
+                self.open()
+            except FileNotFoundError:
+                return
+        if os.fstat(self.stream.fileno()).st_size < self.offset:
+            print(f"File '{self.path}' was truncated, searching it from the start.", file=sys.stderr)
+            self.stream.seek(0)
+            self.offset = 0
+            self.rest = self.rest[:0]
+            if self.decoder is not None:
+                self.decoder.reset()
+            # the lines kept for the next match are gone with the old content
+            self.window.window.clear()
+        yield from self._read()
+        try:
+            file_stat = os.stat(self.path)
+        except FileNotFoundError:
+            # removed or renamed, the old file is read until a new one is created
+            return
+        if (file_stat.st_dev, file_stat.st_ino) != self.identity:
+            if self.rest:
+                # the last line of the old file will not get its line break
+                yield from self._lines(self.rest, last=True)
+            self.close()
+            print(f"File '{self.path}' was replaced, following the new file.", file=sys.stderr)
+            yield from self.search()
+
+    def _read(self):
+        while not self.window.done:
+            started = time.perf_counter() if self.stats is not None else None
+            data = self.stream.read(READ_CHUNK_SIZE)
+            if self.stats is not None:
+                self.stats.bytes_read += len(data)
+                self.stats.times['read'] += time.perf_counter() - started
+            if not data:
+                return
+            self.offset += len(data)
+            if self.decoder is not None:
+                data = self.decoder.decode(data)
+            yield from self._lines(self.rest + data)
+
+    def _lines(self, data, last: bool = False):
+        # only whole lines are searched, the start of a line that is still being written is kept for the next read
+        newline, carriage_return = ('\n', '\r') if self.decoder is not None else (b'\n', b'\r')
+        end = len(data) if last else data.rfind(newline) + 1
+        chunk, self.rest = data[:end], data[end:]
+        if not chunk:
+            return
+        if carriage_return in chunk:
+            chunk = chunk.replace(carriage_return + newline, newline).replace(carriage_return, newline)
+        first = self.number
+        lines = chunk.splitlines(keepends=True)
+        self.number += len(lines)
+        if self.stats is not None:
+            self.stats.lines_scanned += len(lines)
+        window = self.window
+        # the search ends before the last line break, '^' of the multiline pattern would match after it
+        if self.regex is not None and not window.lines_before and window.last_after < first \
+                and self.regex.search(chunk, 0, len(chunk) - chunk.endswith(newline)) is None:
+            # nothing in the chunk matches and no line of it is output around a match
+            return
+        matches = window.matches
+        yield from _format_lines(window.lines(self._events(lines, first)), self.label)
+        if self.stats is not None:
+            self.stats.matches += window.matches - matches
+
+    def _events(self, lines, first: int):
+        regex, search, encoding = self.regex, self.pattern.search, self.encoding
+        window = self.window
+        lines_before, lines_after, last_after = window.lines_before, window.lines_after, window.last_after
+        for number, line in enumerate(lines, first):
+            if regex is not None:
+                matched = regex.search(line, 0, len(line) - line.endswith(b'\n')) is not None
+            else:
+                matched = search(line)
+            if matched:
+                last_after = number + lines_after
+            # the lines that can not be output are left out, the context window drops its lines at the gap
+            if matched or lines_before or number <= last_after:
+                yield number, line.decode(encoding, DECODE_ERRORS) if regex is not None else line, matched
+
+
+def follow_files(search_pattern, filepaths, case_insensitive: bool = False, lines_before: int = 0,
+                 lines_after: int = 0, encoding: str = 'utf-8', show_pattern: bool = False, max_count: int = None,
+                 with_filenames: bool = False, stats: SearchStats = None):
+    """
+    Search files and then keep searching what is appended to them until interrupted, like `tail -F` into a search.
+
+    All the files are followed in one loop. On Linux it waits for changes with inotify, elsewhere or when inotify
+    can not be used the files are polled, every FOLLOW_MIN_INTERVAL seconds after a change and less and less often,
+    up to every FOLLOW_MAX_INTERVAL seconds, while nothing changes. Every file is kept open and read from the offset
+    where the last read ended, truncated and rotated files are noticed by their size and their inode.
+
+    :param search_pattern: pattern to search for, a string or a CompiledPattern
+    :param filepaths: files to follow
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :param lines_before: number of lines to include before a match (default is 0)
+    :param lines_after: number of lines to include after a match (default is 0)
+    :param encoding: encoding of the files (default is 'utf-8')
+    :param show_pattern: flag to prefix every matching line with the pattern that matches it (default is False)
+    :param max_count: stop following a file after this number of matching lines (default is None, follow it forever)
+    :param with_filenames: flag to prefix the lines with the path of their file like a recursive search (default is
+                           False)
+    :param stats: stats to count the files, bytes, lines and matches in (default is None)
+    :return: generator of output lines, it ends only when max_count was reached in every file
+    """
+    pattern = compile_pattern(search_pattern, case_insensitive)
+    label = pattern.matched_pattern if show_pattern else None
+    followed = [_FollowedFile(filepath, pattern, _ContextWindow(lines_before, lines_after, label, max_count),
+                              encoding, filepath if with_filenames else None, stats) for filepath in filepaths]
+    try:
+        watcher = _Inotify()
+        for directory in {file.directory for file in followed}:
+            watcher.watch(directory)
+    except OSError:
+        watcher = None
+    try:
+        interval = FOLLOW_MIN_INTERVAL
+        changed = None
+        while followed:
+            found = False
+            for file in list(followed):
+                if changed is not None and (file.directory, file.name) not in changed:
+                    continue
+                try:
+                    for line in file.search():
+                        found = True
+                        yield line
+                except (OSError, UnicodeError) as err:
+                    print(f"Error reading file '{file.path}': {err}", file=sys.stderr)
+                    file.close()
+                    followed.remove(file)
+                    continue
+                if file.window.done:
+                    file.close()
+                    followed.remove(file)
+            if watcher is not None:
+                changed = watcher.wait(FOLLOW_MAX_INTERVAL)
             else:
-                for line in result[1]:
-                    output_file_content.write(line + '\n')
-            return "", result[1]
+                interval = FOLLOW_MIN_INTERVAL if found else min(interval * 2, FOLLOW_MAX_INTERVAL)
+                time.sleep(interval)
+    finally:
+        for file in followed:
+            file.close()
+        if watcher is not None:
+            watcher.close()
+
+
+def _followed_files(directory: str, path_filter: PathFilter, binary_files: str, max_filesize: int,
+                    encoding: str, stats: SearchStats = None):
+    """
+    Walk a directory for the files a recursive --follow search follows.
+
+    :param stats: stats to count the files of the walk in (default is None)
+    :return: generator of file paths, binary files unless binary_files is 'text', files larger than max_filesize and
+             files that can not be read are left out
+    """
+    filepaths = _walk_files(directory, path_filter, stats)
+    if stats is not None:
+        filepaths = stats.timed(filepaths, 'walk')
+    for filepath in filepaths:
+        try:
+            if max_filesize is not None and os.path.getsize(filepath) > max_filesize:
+                continue
+            with open(filepath, 'rb') as file:
+                sample = file.read(BINARY_CHECK_SIZE)
+        except OSError:
+            continue
+        if binary_files == 'text' or not _looks_binary(sample, encoding):
+            yield filepath
+
+
+class Match(typing.NamedTuple):
+    """
+    One matching line found by iter_matches.
+    """
+    # path of the file, None for a stream
+    path: typing.Optional[str]
+    # number of the line, the first line is 1
+    line_number: int
+    # offset of the first byte of the line in the file
+    offset: int
+    # the decoded line without its line break
+    line: str
+    # (start, end) character positions of the matches in the line
+    spans: list
+
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def _cached_pattern(patterns: tuple, case_insensitive: bool) -> CompiledPattern:
+    return CompiledPattern(list(patterns), case_insensitive)
+
+
+def cached_pattern(search_pattern, case_insensitive: bool = False) -> CompiledPattern:
+    """
+    Compile a search pattern like compile_pattern, the last PATTERN_CACHE_SIZE patterns are kept for repeated queries.
+
+    :param search_pattern: pattern to search for, a list of patterns or a CompiledPattern
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :return: the compiled pattern
+    """
+    if isinstance(search_pattern, CompiledPattern):
+        return search_pattern
+    patterns = (search_pattern,) if isinstance(search_pattern, str) else tuple(search_pattern)
+    return _cached_pattern(patterns, case_insensitive)
+
 
-    if result[1]:
-        if count_only:
-            return "", [len(result[1])]
+def _line_match(pattern: CompiledPattern, path, number: int, offset: int, line: str):
+    spans = [match.span() for match in pattern.regex.finditer(line)]
+    return Match(path, number, offset, line, spans) if spans else None
 
-        output_lines = []
-        if lines_before:
-            output_lines.append("\n".join(result[1][:lines_before]))
 
-        output_lines.append("\n".join(result[1][lines_before:]))
-        output_lines.append(f"I found '{search_pattern}' in the file.")
-        return "", output_lines
-    return "", []
+def _stream_matches(pattern: CompiledPattern, stream, path, encoding: str, max_count: int = None):
+    """
+    Find the matching lines of an open binary file or stream.
+
+    Regular files are searched as a whole memory-mapped buffer when the pattern has a bytes version for the encoding,
+    other streams line by line. Only the matching lines are decoded.
+
+    :param pattern: compiled pattern to search for
+    :param stream: file opened in binary mode
+    :param path: path of the file reported in the matches
+    :param encoding: encoding of the file
+    :param max_count: stop after this number of matching lines (default is None, search the whole file)
+    :return: generator of Match
+    """
+    regex = pattern.bytes_regex_for(encoding)
+    buffer = _map_file(stream) if regex is not None else None
+    count = 0
+    if buffer is not None:
+        with buffer:
+            size = len(buffer)
+            counted_offset, counted_number = 0, 1
+            position = 0
+            while position < size and count != max_count:
+                found = regex.search(buffer, position)
+                if found is None or found.start() == size and buffer[size - 1:size] == b'\n':
+                    return
+                start = buffer.rfind(b'\n', 0, found.start()) + 1
+                end = buffer.find(b'\n', found.start())
+                if end == -1:
+                    end = size
+                number = counted_number + _count_newlines(buffer, counted_offset, start)
+                counted_offset, counted_number = start, number
+                line = buffer[start:end].decode(encoding, DECODE_ERRORS).rstrip('\r')
+                match = _line_match(pattern, path, number, start, line)
+                if match is not None:
+                    yield match
+                    count += 1
+                position = end + 1
+        return
+
+    offset = 0
+    for number, raw_line in enumerate(stream, 1):
+        if count == max_count:
+            return
+        if regex is None or regex.search(raw_line) is not None:
+            match = _line_match(pattern, path, number, offset,
+                                raw_line.decode(encoding, DECODE_ERRORS).rstrip('\r\n'))
+            if match is not None:
+                yield match
+                count += 1
+        offset += len(raw_line)
+
+
+def iter_matches(search_pattern, path: str = None, case_insensitive: bool = False, recursive: bool = False,
+                 encoding: str = 'utf-8', max_count: int = None, path_filter: PathFilter = None,
+                 search_compressed: bool = False, listing: DirectoryListing = None, stream=None):
+    """
+    Search a pattern and yield structured matches instead of output lines, the library API of the search.
+
+    Compiled patterns are cached, so repeated queries with the same pattern do not compile it again. A recursive
+    search skips binary files and files that can not be read.
+
+    :param search_pattern: pattern to search for, a list of patterns or a CompiledPattern
+    :param path: file to search, or directory with recursive (default is None, search stream)
+    :param case_insensitive: flag for case-insensitive search (default value is False, search for case-sensitive)
+    :param recursive: flag to search all the files in the directory path and its subdirectories (default is False)
+    :param encoding: encoding of the input (default is 'utf-8')
+    :param max_count: stop reading a file after this number of matching lines (default is None, read to the end)
+    :param path_filter: filter deciding which files and directories a recursive search skips (default is None)
+    :param search_compressed: flag to decompress gzip, bzip2 and xz files, the offsets are in the decompressed data
+                              then (default is False)
+    :param listing: cache of the directory entries for repeated recursive searches (default is None, list every
+                    directory again)
+    :param stream: binary stream to search when no path is given, e.g. sys.stdin.buffer (default is None)
+    :return: generator of Match in the order of the files and lines
+    :raises re.error: if the pattern is not a valid regular expression
+    :raises LookupError: if the encoding is not known or is not a text encoding
+    :raises OSError: if the file or directory can not be read
+    :raises UnicodeError: if the file can not be decoded at all, e.g. UTF-16 without a byte order mark
+    """
+    pattern = cached_pattern(search_pattern, case_insensitive)
+    error_message = _encoding_error(encoding)
+    if error_message:
+        raise LookupError(error_message)
+    if path is None:
+        yield from _stream_matches(pattern, stream, None, encoding, max_count)
+        return
+    if not recursive:
+        with open_input(path, search_compressed) as file:
+            yield from _stream_matches(pattern, file, path, encoding, max_count)
+        return
+    if not os.path.isdir(path):
+        raise NotADirectoryError(f"Directory '{path}' not found.")
+    for filepath in _walk_files(path, path_filter, listing=listing):
+        try:
+            with open_input(filepath, search_compressed) as file:
+                if _looks_binary(file.peek(BINARY_CHECK_SIZE)[:BINARY_CHECK_SIZE], encoding):
+                    continue
+                yield from _stream_matches(pattern, file, filepath, encoding, max_count)
+        except (OSError, UnicodeError) + DECOMPRESSION_ERRORS:
+            continue
+
+
+class SearchServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Search server answering queries on a Unix socket, so repeated searches skip the startup of the interpreter.
+
+    Every line the client sends is a JSON query with the keyword arguments of iter_matches, e.g.
+    {"pattern": "error", "path": "logs", "recursive": true}. 'include', 'exclude', 'exclude_dir' and 'ignore_files'
+    build the path filter of a recursive search. The server answers with one JSON object per match, with the fields
+    of Match, followed by {"done": true, "matches": N} or by {"error": "message"}. The compiled patterns and the
+    directory listings are shared by all the queries.
+    """
+
+    address_family = getattr(socket, 'AF_UNIX', None)
+    daemon_threads = True
+    allow_reuse_address = False
+
+    def __init__(self, socket_path: str):
+        """
+        :param socket_path: path of the Unix socket to listen on, a stale socket left there is replaced
+        :raises OSError: if another server listens on the socket or the path is not a socket
+        """
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(socket_path)
+                except ConnectionRefusedError:
+                    # nobody listens, the socket was left by a server that did not shut down cleanly
+                    os.unlink(socket_path)
+                else:
+                    raise OSError(f"A server is already listening on '{socket_path}'.")
+        self.listing = DirectoryListing()
+        super().__init__(socket_path, _SearchRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class _SearchRequestHandler(socketserver.StreamRequestHandler):
+    # the matches of a query are sent in large writes, the buffer is flushed at the end of every query
+    wbufsize = WRITE_BUFFER_SIZE
+
+    def handle(self):
+        for query_line in self.rfile:
+            count = 0
+            try:
+                query = json.loads(query_line)
+                path_filter = None
+                if any(query.get(key) for key in ('include', 'exclude', 'exclude_dir', 'ignore_files')):
+                    path_filter = PathFilter(query.get('include'), query.get('exclude'), query.get('exclude_dir'),
+                                             query.get('ignore_files', False))
+                matches = iter_matches(query['pattern'], query['path'], query.get('case_insensitive', False),
+                                       query.get('recursive', False), query.get('encoding', 'utf-8'),
+                                       query.get('max_count'), path_filter, query.get('search_compressed', False),
+                                       self.server.listing)
+                for match in matches:
+                    self.wfile.write(json.dumps(match._asdict()).encode('utf-8') + b'\n')
+                    count += 1
+                reply = {'done': True, 'matches': count}
+            except (KeyError, TypeError, ValueError, LookupError, re.error, OSError) + DECOMPRESSION_ERRORS as err:
+                reply = {'error': f"{type(err).__name__}: {err}"}
+            try:
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                # the client is gone
+                return
+
+
+def query_server(socket_path: str, search_pattern, path: str, **options):
+    """
+    Send a query to a SearchServer and yield its matches.
+
+    :param socket_path: path of the Unix socket of the server
+    :param search_pattern: pattern to search for or list of patterns
+    :param path: file or directory to search, relative to the working directory of the server
+    :param options: other keyword arguments of iter_matches and the path filter, see SearchServer
+    :return: generator of Match
+    :raises RuntimeError: if the server reports an error or the answer ends before the query is done
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps({'pattern': search_pattern, 'path': path, **options}).encode('utf-8') + b'\n')
+        with client.makefile('rb', buffering=READ_CHUNK_SIZE) as replies:
+            for reply_line in replies:
+                reply = json.loads(reply_line)
+                if 'error' in reply:
+                    raise RuntimeError(reply['error'])
+                if reply.get('done'):
+                    return
+                yield Match(reply['path'], reply['line_number'], reply['offset'], reply['line'],
+                            [tuple(span) for span in reply['spans']])
+    # the server closed the connection in the middle of the answer, the matches may be incomplete
+    raise RuntimeError("The server closed the connection before the query was done.")
+
+
+def generate_corpus(directory: str, corpus: str = 'large-file', size: int = 16 * 1024 * 1024,
+                    match_rate: str = 'sparse', seed: int = 0) -> dict:
+    """
+    Write a synthetic log corpus for the benchmark, the same arguments always give the same files.
+
+    :param directory: directory to write the corpus to, it is created if it does not exist
+    :param corpus: one of BENCH_CORPORA (default is 'large-file')
+    :param size: total number of bytes of the corpus (default is 16 MiB)
+    :param match_rate: one of BENCH_MATCH_RATES, the share of the lines that match (default is 'sparse')
+    :param seed: seed of the random numbers the lines are made of (default is 0)
+    :return: dictionary with the number of files, lines and bytes of the corpus
+    """
+    rng = random.Random(f"{corpus}/{match_rate}/{seed}")
+    rate = BENCH_MATCH_RATES[match_rate]
+    if corpus == 'large-file':
+        filepaths = [os.path.join(directory, 'large.log')]
+    elif corpus == 'small-files':
+        filepaths = [os.path.join(directory, f'file{number:06}.log')
+                     for number in range(max(1, size // BENCH_SMALL_FILE_SIZE))]
+    elif corpus == 'deep-tree':
+        # the files are spread over a tree with four subdirectories per level
+        filepaths = [os.path.join(directory, *(f'level{level}-{number // 4 ** level % 4}'
+                                               for level in range(BENCH_TREE_DEPTH)), f'file{number:06}.log')
+                     for number in range(max(1, size // BENCH_SMALL_FILE_SIZE))]
+    else:
+        raise ValueError(f"Unknown corpus '{corpus}'.")
+
+    file_size = size // len(filepaths)
+    lines = written = 0
+    for filepath in filepaths:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        file_lines = []
+        file_written = 0
+        while file_written < file_size:
+            words = [rng.choice(BENCH_WORDS) for _ in range(rng.randint(4, 14))]
+            if rng.random() < rate:
+                words.insert(rng.randrange(len(words) + 1), f'needle-{rng.randrange(10000)}')
+            line = ' '.join(words) + '\n'
+            file_lines.append(line)
+            file_written += len(line)
+        with open(filepath, 'w', encoding='utf-8', newline='\n') as file:
+            file.writelines(file_lines)
+        lines += len(file_lines)
+        written += file_written
+    return {'files': len(filepaths), 'lines': lines, 'bytes': written}
+
+
+def _bench_files(directory: str) -> list:
+    return sorted(_walk_files(directory))
+
+
+def _run_benchmark(directory: str, target: str, pattern_name: str, repeat: int, jobs: int) -> dict:
+    """
+    Time one function of BENCH_TARGETS on a corpus, runs in its own process to measure its peak memory use.
+
+    :param directory: directory of the corpus
+    :param target: one of BENCH_TARGETS
+    :param pattern_name: key of BENCH_PATTERNS
+    :param repeat: number of runs, the fastest one is reported
+    :param jobs: number of worker processes of search_files_recursive
+    :return: dictionary with the wall time of the fastest run, the number of output lines and the peak RSS in KiB
+    """
+    search_pattern, case_insensitive, context = BENCH_PATTERNS[pattern_name]
+    filepaths = _bench_files(directory)
+    lines = None
+    if target == 'search_pattern_in_strings':
+        # the lines are read before the clock starts, only the search is timed
+        lines = []
+        for filepath in filepaths:
+            with open(filepath, encoding='utf-8') as file:
+                lines.extend(file)
+
+    def run() -> int:
+        if target == 'search_pattern_in_strings':
+            return len(search_pattern_in_strings(search_pattern, lines, case_insensitive, context, context)[1])
+        if target == 'my_grep':
+            output_lines = 0
+            for filepath in filepaths:
+                output_lines += sum(1 for _ in my_grep(search_pattern, filepath, case_insensitive=case_insensitive,
+                                                       lines_before=context, lines_after=context)[1])
+            return output_lines
+        error_message, output = search_files_recursive(directory, search_pattern, case_insensitive,
+                                                       lines_before=context, lines_after=context, jobs=jobs)
+        if error_message:
+            raise RuntimeError(error_message)
+        return sum(1 for _ in output)
+
+    wall_times = []
+    output_lines = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output_lines = run()
+        wall_times.append(time.perf_counter() - start)
+    peak_rss = None
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak_rss //= 1024
+    return {'wall_time': min(wall_times), 'output_lines': output_lines, 'peak_rss_kb': peak_rss}
+
+
+def bench(corpora=BENCH_CORPORA, match_rates=tuple(BENCH_MATCH_RATES), targets=BENCH_TARGETS,
+          patterns=tuple(BENCH_PATTERNS), size: int = 16 * 1024 * 1024, seed: int = 0, repeat: int = 3,
+          jobs: int = 1, directory: str = None) -> dict:
+    """
+    Benchmark the search functions on generated corpora.
+
+    Every combination of corpus, match rate, function and pattern is timed in a fresh process. The throughput is
+    worked out from the fastest of `repeat` runs.
+
+    :param corpora: corpora to generate, see BENCH_CORPORA (default is all of them)
+    :param match_rates: match rates to generate every corpus with, see BENCH_MATCH_RATES (default is all of them)
+    :param targets: functions to time, see BENCH_TARGETS (default is all of them)
+    :param patterns: names of the patterns to search for, see BENCH_PATTERNS (default is all of them)
+    :param size: number of bytes of every corpus (default is 16 MiB)
+    :param seed: seed of the generated corpora (default is 0)
+    :param repeat: number of runs of every benchmark (default is 3)
+    :param jobs: number of worker processes of search_files_recursive (default is 1)
+    :param directory: directory to keep the corpora in, an existing corpus is reused (default is None, generate
+                      the corpora in a temporary directory that is removed afterwards)
+    :return: dictionary with the settings of the run and a list with the result of every benchmark
+    """
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'size': size, 'seed': seed, 'repeat': repeat, 'jobs': jobs},
+        'results': [],
+    }
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        for corpus in corpora:
+            for match_rate in match_rates:
+                corpus_directory = os.path.join(directory or temporary_directory, f'{corpus}-{match_rate}-{seed}')
+                if os.path.isdir(corpus_directory) and _bench_files(corpus_directory):
+                    filepaths = _bench_files(corpus_directory)
+                    corpus_stats = {'files': len(filepaths), 'lines': 0, 'bytes': 0}
+                    for filepath in filepaths:
+                        with open(filepath, 'rb') as file:
+                            data = file.read()
+                        corpus_stats['lines'] += data.count(b'\n')
+                        corpus_stats['bytes'] += len(data)
+                else:
+                    corpus_stats = generate_corpus(corpus_directory, corpus, size, match_rate, seed)
+                for target in targets:
+                    for pattern_name in patterns:
+                        # a fresh process per benchmark, so the peak memory use is that of this benchmark only
+                        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                            timing = executor.submit(_run_benchmark, corpus_directory, target, pattern_name, repeat,
+                                                     jobs).result()
+                        wall_time = timing['wall_time'] or float('inf')
+                        report['results'].append({
+                            'corpus': corpus,
+                            'match_rate': match_rate,
+                            'target': target,
+                            'pattern': pattern_name,
+                            **corpus_stats,
+                            'output_lines': timing['output_lines'],
+                            'wall_time': round(timing['wall_time'], 6),
+                            'lines_per_second': round(corpus_stats['lines'] / wall_time),
+                            'mb_per_second': round(corpus_stats['bytes'] / wall_time / 1024 ** 2, 2),
+                            'peak_rss_kb': timing['peak_rss_kb'],
+                        })
+    return report
+
+
+def _report_search(stats: SearchStats, profiler, profile_path: str, started: float):
+    """
+    Report the stats of a search on STDERR and write its profile.
+
+    :param stats: stats of the search or None
+    :param profiler: cProfile.Profile that ran during the search or None
+    :param profile_path: file to write the profile to
+    :param started: time.perf_counter() when the search started
+    """
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+    if stats is not None:
+        for line in stats.report():
+            print(line, file=sys.stderr)
+        print(f"total time: {time.perf_counter() - started:.3f}s", file=sys.stderr)
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['bench']:
+        parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} bench",
+                                         description="benchmark the search on generated corpora and print the "
+                                                     "results as JSON.")
+        parser.add_argument('--corpus', action='append', choices=BENCH_CORPORA,
+                            help="Corpus to generate, can be repeated (default is all of them)")
+        parser.add_argument('--match-rate', action='append', choices=tuple(BENCH_MATCH_RATES),
+                            help="Share of matching lines of the corpora, can be repeated (default is all of them)")
+        parser.add_argument('--target', action='append', choices=BENCH_TARGETS,
+                            help="Function to time, can be repeated (default is all of them)")
+        parser.add_argument('--pattern', action='append', choices=tuple(BENCH_PATTERNS),
+                            help="Kind of pattern to search for, can be repeated (default is all of them)")
+        parser.add_argument('--size', type=parse_size, default=16 * 1024 * 1024, metavar='SIZE',
+                            help="Size of every corpus in bytes, K, M and G suffixes are allowed (default is 16M)")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the generated corpora (default is 0)")
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Number of runs of every benchmark, the fastest is reported (default is 3)")
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help="Worker processes of the recursive search, 0 uses one per CPU (default is 1)")
+        parser.add_argument('--directory', metavar='DIRECTORY',
+                            help="Keep the corpora in DIRECTORY and reuse them in later runs")
+        parser.add_argument('-o', '--output_file', type=str, help="the file to write the JSON results to")
+        args = parser.parse_args(sys.argv[2:])
+        if args.repeat < 1:
+            parser.error(f"argument --repeat: invalid number of runs: '{args.repeat}'")
+        if args.jobs < 0:
+            parser.error(f"argument -j/--jobs: invalid number of jobs: '{args.jobs}'")
+        report = bench(args.corpus or BENCH_CORPORA, args.match_rate or tuple(BENCH_MATCH_RATES),
+                       args.target or BENCH_TARGETS, args.pattern or tuple(BENCH_PATTERNS), args.size, args.seed,
+                       args.repeat, args.jobs, args.directory)
+        if args.output_file:
+            with open(args.output_file, 'w') as output_file_content:
+                json.dump(report, output_file_content, indent=2)
+                output_file_content.write('\n')
+        else:
+            print(json.dumps(report, indent=2))
+        sys.exit()
+
+    if sys.argv[1:2] == ['serve']:
+        parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} serve",
+                                         description="answer search queries on a Unix socket until interrupted.")
+        parser.add_argument('socket', type=str, help="the path of the Unix socket to listen on")
+        args = parser.parse_args(sys.argv[2:])
+        if SearchServer.address_family is None:
+            parser.error("Unix sockets are not supported on this platform")
+        try:
+            server = SearchServer(args.socket)
+        except OSError as err:
+            sys.exit(str(err))
+        # stop on SIGTERM like on Ctrl-C, so the socket file is removed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        with server:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        sys.exit()
+
+    if sys.argv[1:2] == ['index']:
+        parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} index",
+                                         description="build or update the trigram index of a directory.")
+        parser.add_argument('directory', type=str, help="the directory to index")
+        parser.add_argument('--max-filesize', type=parse_size, metavar='SIZE',
+                            help="Do not index files larger than SIZE bytes, they are always searched")
+        parser.add_argument('--include', action='append', metavar='GLOB',
+                            help="Index only files whose name matches GLOB, can be repeated")
+        parser.add_argument('--exclude', action='append', metavar='GLOB',
+                            help="Do not index files whose name matches GLOB, can be repeated")
+        parser.add_argument('--exclude-dir', action='append', metavar='GLOB',
+                            help="Do not index directories whose name matches GLOB, can be repeated")
+        parser.add_argument('--ignore-files', action='store_true',
+                            help="Do not index .git directories and what .gitignore and .ignore files list")
+        args = parser.parse_args(sys.argv[2:])
+        path_filter = None
+        if args.include or args.exclude or args.exclude_dir or args.ignore_files:
+            path_filter = PathFilter(args.include, args.exclude, args.exclude_dir, args.ignore_files)
+        error_message, result = build_index(args.directory, path_filter, args.max_filesize)
+        print(error_message or '\n'.join(result))
+        sys.exit()
+
     parser = argparse.ArgumentParser(description="search for a string/patten in the file.")
-    parser.add_argument('search_string', type=str, help="the string to search for")
+    parser.add_argument('search_string', type=str, help="the string to search for", nargs="?")
     parser.add_argument('filename', type=str, help="the filename to search from", nargs="?")
     parser.add_argument('-o', '--output_file', type=str, help="the file to write output")
     parser.add_argument('-i', '--insensitive', action='store_true', help='This will allow case-insensitive search')
@@ -170,13 +3348,141 @@ if __name__ == '__main__':
     parser.add_argument('-B', '--lines_after_match', type=int, help="Print N lines after the match", default=0)
     parser.add_argument('-r', '--recursive', action='store_true',
                         help='Search recursively in all files in the given directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Search files of a recursive search with N worker processes, 0 uses one per CPU')
+    parser.add_argument('--binary-files', choices=BINARY_FILES_POLICIES, default='binary',
+                        help="What a recursive search does with binary files: report that they match (binary), skip "
+                             "them (without-match) or search them as text (text)")
+    parser.add_argument('--max-filesize', type=parse_size, metavar='SIZE',
+                        help="Skip files larger than SIZE bytes in a recursive search, K, M and G suffixes are allowed")
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help="Search only files whose name matches GLOB in a recursive search, can be repeated")
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help="Skip files whose name matches GLOB in a recursive search, can be repeated")
+    parser.add_argument('--exclude-dir', action='append', metavar='GLOB',
+                        help="Skip directories whose name matches GLOB in a recursive search, can be repeated")
+    parser.add_argument('--ignore-files', action='store_true',
+                        help="Skip .git directories and what .gitignore and .ignore files list in a recursive search")
+    parser.add_argument('--index', action='store_true',
+                        help="Skip the files the trigram index of the directory proves can not match in a recursive "
+                             "search, the index is built with 'index DIRECTORY'")
+    parser.add_argument('-e', '--regexp', action='append', metavar='PATTERN',
+                        help="Search for PATTERN, can be repeated to search for any of several patterns, the first "
+                             "positional argument is then the filename")
+    parser.add_argument('-f', '--file', action='append', metavar='FILE',
+                        help="Search for the patterns in FILE, one per line, can be repeated")
+    parser.add_argument('--show-pattern', action='store_true',
+                        help="Prefix every matching line with the pattern that matches it")
+    parser.add_argument('-m', '--max-count', type=int, metavar='NUM',
+                        help="Stop reading a file after NUM matching lines")
+    list_files = parser.add_mutually_exclusive_group()
+    list_files.add_argument('-l', '--files-with-matches', dest='list_files', action='store_const',
+                            const='with-match', help="Print only the names of the files that match")
+    list_files.add_argument('-L', '--files-without-match', dest='list_files', action='store_const',
+                            const='without-match', help="Print only the names of the files that do not match")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="Print nothing and exit with status 0 at the first match, 1 if nothing matches")
+    parser.add_argument('--encoding', default='utf-8',
+                        help="Encoding of the searched files and STDIN (default is utf-8), bytes that are not valid in "
+                             "it are replaced")
+    parser.add_argument('-z', '--search-compressed', action='store_true',
+                        help="Decompress gzip, bzip2 and xz input while it is searched, the format is told by the "
+                             "first bytes")
+    parser.add_argument('--stats', action='store_true',
+                        help="Report the files walked, skipped and searched, the bytes read, the lines scanned, the "
+                             "matches and the time spent walking, reading, matching and writing on STDERR")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Write a cProfile dump of the search to FILE, worker processes of -j are not profiled")
+    parser.add_argument('--follow', action='store_true',
+                        help="Keep searching the lines appended to the file, or to the files of the directory with -r, "
+                             "until interrupted; rotated and truncated files are followed")
+    parser.add_argument('--line-buffered', action='store_true',
+                        help="Write every line as soon as it is found, this is the default when the output is a "
+                             "terminal")
     args = parser.parse_args()
-    error_message, result = my_grep(args.search_string, filename=args.filename, output_file_path=args.output_file,
+    if args.max_count is not None and args.max_count < 0:
+        parser.error(f"argument -m/--max-count: invalid count: '{args.max_count}'")
+    if args.jobs < 0:
+        parser.error(f"argument -j/--jobs: invalid number of jobs: '{args.jobs}'")
+    if args.lines_before_match < 0:
+        parser.error(f"argument -A/--lines_before_match: invalid context length: '{args.lines_before_match}'")
+    if args.lines_after_match < 0:
+        parser.error(f"argument -B/--lines_after_match: invalid context length: '{args.lines_after_match}'")
+    if args.follow:
+        for option, name in ((args.count_only, '-C/--count_only'), (args.list_files, '-l/-L'),
+                             (args.output_file, '-o/--output_file'), (args.search_compressed, '-z/--search-compressed'),
+                             (args.index, '--index')):
+            if option:
+                parser.error(f"argument --follow: not allowed with argument {name}")
+    search_pattern, filename = args.search_string, args.filename
+    if args.regexp or args.file:
+        if args.filename is not None:
+            parser.error(f"unrecognized arguments: {args.filename}")
+        search_pattern, filename = list(args.regexp or []), args.search_string
+        for pattern_file in args.file or []:
+            try:
+                search_pattern.extend(read_patterns(pattern_file))
+            except OSError as err:
+                parser.error(f"can't read pattern file '{pattern_file}': {err.strerror}")
+    elif search_pattern is None:
+        parser.error("the following arguments are required: search_string")
+    if args.follow and filename is None:
+        parser.error("argument --follow: a file or a directory to follow is required")
+    output_file = None if args.quiet else args.output_file
+    stats = SearchStats() if args.stats else None
+    profiler = cProfile.Profile() if args.profile else None
+    if stats is not None or profiler is not None:
+        # reported however the search ends, sys.exit included
+        atexit.register(_report_search, stats, profiler, args.profile, time.perf_counter())
+    if args.follow:
+        # stop on SIGTERM like on Ctrl-C, so the followed files are closed and the stats are reported
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if profiler is not None:
+        profiler.enable()
+    error_message, result = my_grep(search_pattern, filename=filename, output_file_path=output_file,
                                     case_insensitive=args.insensitive, count_only=args.count_only,
                                     lines_before=args.lines_before_match,
-                                    lines_after=args.lines_after_match, recursive=args.recursive)
+                                    lines_after=args.lines_after_match, recursive=args.recursive, jobs=args.jobs,
+                                    binary_files=args.binary_files, max_filesize=args.max_filesize,
+                                    include=args.include, exclude=args.exclude, exclude_dir=args.exclude_dir,
+                                    ignore_files=args.ignore_files, use_index=args.index,
+                                    show_pattern=args.show_pattern, max_count=args.max_count,
+                                    list_files=args.list_files, quiet=args.quiet, encoding=args.encoding,
+                                    search_compressed=args.search_compressed, stats=stats, follow=args.follow)
     if error_message:
         print(f"{error_message}")
-    else:
-        for line in result:
-            print(line)
+        sys.exit(EXIT_ERROR)
+    if args.quiet:
+        selected = next(iter(result), None) is not None
+        if hasattr(result, 'close'):
+            result.close()
+        sys.exit(EXIT_MATCH if selected else EXIT_NO_MATCH)
+    try:
+        # followed files are searched until interrupted, their lines are written as soon as they are found
+        with OutputSink(sys.stdout.buffer, sys.stdout.encoding, sys.stdout.errors,
+                        args.line_buffered or args.follow or sys.stdout.isatty(), stats) as sink:
+            try:
+                selected = sink.write_lines(map(str, result)) > 0
+            except KeyboardInterrupt:
+                if hasattr(result, 'close'):
+                    result.close()
+                if not args.follow:
+                    # the lines written so far are flushed when the sink is closed
+                    sys.exit(EXIT_INTERRUPTED)
+                # the way a --follow search ends
+                selected = sink.lines_written > 0
+    except BrokenPipeError:
+        # the reader is gone, e.g. `| head`, so the search stops here; stdout is pointed at devnull to keep Python
+        # from failing again when it flushes stdout at exit
+        if hasattr(result, 'close'):
+            result.close()
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(EXIT_ERROR)
+    except (OSError, UnicodeError) + DECOMPRESSION_ERRORS as err:
+        # e.g. a compressed file that is cut short or UTF-16 input without a byte order mark
+        print(f"Error reading file '{filename or '(standard input)'}': {err}", file=sys.stderr)
+        sys.exit(EXIT_ERROR)
+    # the output file is only created when something matches
+    if output_file and os.path.exists(os.path.join(os.getcwd(), output_file)):
+        selected = True
+    sys.exit(EXIT_MATCH if selected else EXIT_NO_MATCH)
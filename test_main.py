@@ -1,7 +1,16 @@
+import bz2
+import gzip
+import json
+import lzma
 import os.path
 import unittest
 import subprocess
 import shutil
+import signal
+import threading
+import time
+
+import main
 
 
 def create_dir_for_recursive_test(directory_name):
@@ -52,6 +61,15 @@ class GrepTestCases(unittest.TestCase):
                           "I found 'line' in the file.\n"
         self.assertEqual(result.stdout, expected_output)
 
+    def test_crlf_file(self):
+        filename = "crlf_file.txt"
+        with open(filename, 'wb') as file:
+            file.write(b'first line\r\nsecond line\r\nthird line\r\n')
+        result = subprocess.run(['python', 'main.py', 'second', filename, '-B', '1'], capture_output=True, text=True)
+        expected_output = "second line\nthird line\nI found 'second' in the file.\n"
+        self.assertEqual(result.stdout, expected_output)
+        os.remove(filename)
+
     def test_file_not_found(self):
         result = subprocess.run(['python', 'main.py', 'param', 'non_existing_file.txt'], capture_output=True, text=True)
         expected_output = "File 'non_existing_file.txt' not found.\n"
@@ -100,6 +118,8 @@ class GrepTestCases(unittest.TestCase):
                                 text=True)
         # check if the command executed successfully
         self.assertEqual(result.returncode, 0)
+        # the matching lines are printed as well
+        self.assertEqual(result.stdout, expected_content)
 
         # check if the file created or not
         self.assertTrue(os.path.exists(os.path.join(os.getcwd(), output_filename)))
@@ -167,10 +187,143 @@ class GrepTestCases(unittest.TestCase):
         expected_output = "2\n"  # Expected count of matches
         self.assertEqual(result.stdout, expected_output)
 
+    def test_grep_stdin_with_context(self):
+        result = subprocess.run(
+            ['python', 'main.py', 'foo', '-A', '1', '-B', '1'], text=True, capture_output=True,
+            input='bar\nbarbazfoo\nFoobar\nbaz\nbaz\nfood\n'
+        )
+        expected_output = "bar\nbarbazfoo\nFoobar\n--\nbaz\nfood\nI found 'foo' in the file.\n"
+        self.assertEqual(result.stdout, expected_output)
+
+        # overlapping windows are merged and every line is printed once
+        result = subprocess.run(['python', 'main.py', 'foo', '-A', '2', '-B', '2'], text=True, capture_output=True,
+                                input='foo1\nfoo2\nbar\nfoo3\nbaz\nbaz\nbaz\n')
+        expected_output = "foo1\nfoo2\nbar\nfoo3\nbaz\nbaz\nI found 'foo' in the file.\n"
+        self.assertEqual(result.stdout, expected_output)
+
+        # anchors match at the ends of every line, not after its line break
+        result = subprocess.run(['python', 'main.py', '^$', '-B', '1'], text=True, capture_output=True,
+                                input='a\n\nb\nc\n')
+        self.assertEqual(result.stdout, "\nb\nI found '^$' in the file.\n")
+        result = subprocess.run(['python', 'main.py', '^$', '-A', '1'], text=True, capture_output=True,
+                                input='a\n\nb\nc\n')
+        self.assertEqual(result.stdout, "a\n\nI found '^$' in the file.\n")
+
+    def test_grep_multiple_patterns(self):
+        result = subprocess.run(
+            ['python', 'main.py', '-e', 'foo', '-e', 'x.z', '--show-pattern'], text=True, capture_output=True,
+            input='bar\nbarbazfoo\nxyz\nbaz\n'
+        )
+        expected_output = "[foo] barbazfoo\n[x.z] xyz\nI found 'foo', 'x.z' in the file.\n"
+        self.assertEqual(result.stdout, expected_output)
+
+        # without lines around the matches no group separator is printed
+        result = subprocess.run(['python', 'main.py', '-e', 'foo', '-e', 'x.z', '--show-pattern'], text=True,
+                                capture_output=True, input='foo\nbar\nxyz\n')
+        self.assertEqual(result.stdout, "[foo] foo\n[x.z] xyz\nI found 'foo', 'x.z' in the file.\n")
+
+        # backreferences keep pointing at the groups of their own pattern
+        result = subprocess.run(['python', 'main.py', '-e', '(x)y', '-e', '(c)\\1', '--show-pattern'], text=True,
+                                capture_output=True, input='cc\nxy\nc\n')
+        self.assertEqual(result.stdout, "[(c)\\1] cc\n[(x)y] xy\nI found '(x)y', '(c)\\1' in the file.\n")
+        result = subprocess.run(['python', 'main.py', '-e', '(a)\\1', '-e', 'foo'], text=True, capture_output=True,
+                                input='aa\nab\nfoo\n')
+        self.assertEqual(result.stdout, "aa\nfoo\nI found '(a)\\1', 'foo' in the file.\n")
+        # global inline flags only apply to their own pattern
+        result = subprocess.run(['python', 'main.py', '-e', 'foo', '-e', '(?i)bar'], text=True, capture_output=True,
+                                input='BAR\nFOO\nfoo\n')
+        self.assertEqual(result.stdout, "BAR\nfoo\nI found 'foo', '(?i)bar' in the file.\n")
+
+    def test_grep_patterns_from_file(self):
+        with open('param_test.txt', 'w') as f:
+            f.write('error\nWARN\n')
+        result = subprocess.run(['python', 'main.py', '-f', 'param_test.txt', '-i', '-C'], text=True,
+                                capture_output=True, input='Error one\nok\nwarning two\nok\n')
+        self.assertEqual(result.stdout, "2\n")
+        os.remove('param_test.txt')
+
+    def test_grep_max_count_and_quiet(self):
+        content = 'foo one\nbar\nfoo two\nfoo three\n'
+        result = subprocess.run(['python', 'main.py', 'foo', '-m', '2'], text=True, capture_output=True,
+                                input=content)
+        self.assertEqual(result.stdout, "foo one\nfoo two\nI found 'foo' in the file.\n")
+        self.assertEqual(result.returncode, 0)
+        result = subprocess.run(['python', 'main.py', 'foo', '-q'], text=True, capture_output=True, input=content)
+        self.assertEqual((result.stdout, result.returncode), ("", 0))
+        result = subprocess.run(['python', 'main.py', 'baz', '-q'], text=True, capture_output=True, input=content)
+        self.assertEqual((result.stdout, result.returncode), ("", 1))
+        result = subprocess.run(['python', 'main.py', 'foo', 'non_existing_file.txt'], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 2)
+
+    def test_grep_stdin_with_encoding(self):
+        content = b'caf\xe9 one\r\nplain\rcaf\xe9 two\n'
+        result = subprocess.run(['python', 'main.py', 'caf', '--encoding', 'latin-1'], capture_output=True,
+                                input=content)
+        self.assertEqual(result.stdout.decode('utf-8'), "caf\xe9 one\ncaf\xe9 two\nI found 'caf' in the file.\n")
+        result = subprocess.run(['python', 'main.py', 'two', '-A', '1'], capture_output=True, input=content)
+        self.assertEqual(result.stdout.decode('utf-8'), "plain\ncaf\ufffd two\nI found 'two' in the file.\n")
+        result = subprocess.run(['python', 'main.py', 'caf', '--encoding', 'no-such-encoding'], capture_output=True,
+                                input=content)
+        self.assertEqual((result.stdout, result.returncode), (b"Unknown encoding 'no-such-encoding'.\n", 2))
+        result = subprocess.run(['python', 'main.py', 'caf', '--encoding', 'rot13'], capture_output=True,
+                                input=content)
+        self.assertEqual((result.stdout, result.returncode), (b"Encoding 'rot13' is not a text encoding.\n", 2))
+        # a decoder that rejects the whole input is reported as an error, not with a traceback
+        result = subprocess.run(['python', 'main.py', 'caf', '--encoding', 'utf-16'], capture_output=True,
+                                input=content)
+        self.assertEqual((result.stdout, result.returncode),
+                         (b"Error reading file '(standard input)': UTF-16 stream does not start with BOM\n", 2))
+        dir_name = 'test_encoding'
+        os.makedirs(dir_name, exist_ok=True)
+        with open(os.path.join(dir_name, 'no_bom.txt'), 'wb') as f:
+            f.write(b'caf\n')
+        with open(os.path.join(dir_name, 'with_bom.txt'), 'wb') as f:
+            f.write('caf\n'.encode('utf-16'))
+        result = subprocess.run(['python', 'main.py', 'caf', dir_name, '-r', '--encoding', 'utf-16'],
+                                capture_output=True, text=True)
+        shutil.rmtree(dir_name)
+        self.assertEqual(result.stdout, f"{os.path.join(dir_name, 'with_bom.txt')}: caf\n")
+        self.assertEqual(result.stderr, f"Error reading file '{os.path.join(dir_name, 'no_bom.txt')}': "
+                                        "UTF-16 stream does not start with BOM\n")
+
+    def test_grep_large_stdin(self):
+        content = 'no match here\n' * 200000 + 'the needle line\n' + 'no match here\n' * 200000
+        result = subprocess.run(['python', 'main.py', 'needle'], text=True, capture_output=True, input=content)
+        expected_output = "the needle line\nI found 'needle' in the file.\n"
+        self.assertEqual(result.stdout, expected_output)
+
+    def test_grep_output_closed_early(self):
+        filename = "test_closed_early.txt"
+        with open(filename, 'w') as f:
+            f.write('needle\n' * 500000)
+        grep = subprocess.Popen(['python', 'main.py', 'needle', filename], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True)
+        head = subprocess.run(['head', '-n', '2'], stdin=grep.stdout, capture_output=True, text=True, timeout=60)
+        grep.stdout.close()
+        self.assertEqual(head.stdout, "needle\nneedle\n")
+        self.assertEqual(grep.communicate(timeout=60)[1], "")
+        os.remove(filename)
+        result = subprocess.run(['python', 'main.py', 'needle', '--line-buffered'], text=True, capture_output=True,
+                                input='needle\nhay\n')
+        self.assertEqual(result.stdout, "needle\nI found 'needle' in the file.\n")
+
+    def test_escaped_literal_pattern(self):
+        result = subprocess.run(['python', 'main.py', r'v1\.2'], text=True, capture_output=True,
+                                input='v1x2\nrelease v1.2\n')
+        expected_output = "release v1.2\nI found 'v1\\.2' in the file.\n"
+        self.assertEqual(result.stdout, expected_output)
+
+    def test_invalid_pattern(self):
+        result = subprocess.run(['python', 'main.py', 'foo(', 'test.txt'], capture_output=True, text=True)
+        self.assertTrue(result.stdout.startswith("Invalid pattern 'foo(':"))
+
     def test_lines_before_match(self):
         result = subprocess.run(['python', 'main.py', 'second', 'test.txt', '-A', '1'], capture_output=True, text=True)
         expected_output = "This is the first line.\nThis is the second line.\nI found 'second' in the file.\n"
         self.assertEqual(result.stdout, expected_output)
+        result = subprocess.run(['python', 'main.py', 'second', 'test.txt', '-A=-1'], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("invalid context length", result.stderr)
 
     def test_lines_after_match(self):
         result = subprocess.run(['python', 'main.py', 'second', 'test.txt', '-B', '2'], capture_output=True, text=True)
@@ -210,13 +363,350 @@ class GrepTestCases(unittest.TestCase):
         result = subprocess.run(['python', 'main.py', 'test', 'test_recursive_search', '-r', '-A', '1', '-B', '1'],
                                 capture_output=True, text=True)
         expected_output = 'test_recursive_search/file1.txt: This is a test file.\n' \
-                          'test_recursive_search/file1.txt: \n' \
+                          '--\n' \
+                          'test_recursive_search/subdir/file2.txt: One can test a program by running test cases.\n' \
+                          '--\n' \
+                          'test_recursive_search/subdir/file3.txt: This file contains a test line.\n'
+        self.assertEqual(result.stdout, expected_output)
+
+    def test_recursive_search_parallel(self):
+        if not os.path.exists('test_recursive_search'):
+            create_dir_for_recursive_test('test_recursive_search')
+        result = subprocess.run(['python', 'main.py', 'test', 'test_recursive_search', '-r', '-j', '2'],
+                                capture_output=True, text=True)
+        expected_output = 'test_recursive_search/file1.txt: This is a test file.\n' \
                           'test_recursive_search/subdir/file2.txt: One can test a program by running test cases.\n' \
-                          'test_recursive_search/subdir/file2.txt: \n' \
-                          'test_recursive_search/subdir/file3.txt: This file contains a test line.\n' \
-                          'test_recursive_search/subdir/file3.txt: \n'
+                          'test_recursive_search/subdir/file3.txt: This file contains a test line.\n'
         self.assertEqual(result.stdout, expected_output)
+        result = subprocess.run(['python', 'main.py', 'test', 'test_recursive_search', '-r', '--jobs=-2'],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("invalid number of jobs", result.stderr)
 
+    def test_recursive_search_parallel_count_only(self):
+        if not os.path.exists('test_recursive_search'):
+            create_dir_for_recursive_test('test_recursive_search')
+        result = subprocess.run(['python', 'main.py', 'test', 'test_recursive_search', '-r', '-C', '-j', '0'],
+                                capture_output=True, text=True)
+        expected_output = 'test_recursive_search/file1.txt: 1\n' \
+                          'test_recursive_search/subdir/file2.txt: 1\n' \
+                          'test_recursive_search/subdir/file3.txt: 1\n'
+        self.assertEqual(result.stdout, expected_output)
+
+    def test_recursive_search_binary_files(self):
+        dir_name = "test_binary_search"
+        os.makedirs(dir_name, exist_ok=True)
+        with open(os.path.join(dir_name, 'image.bin'), 'wb') as f:
+            f.write(b'\x89PNG\x00\x01test\xff\xfe')
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r'], capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"Binary file {dir_name}/image.bin matches\n")
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r', '--binary-files', 'without-match'],
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout, "")
+        shutil.rmtree(dir_name)
+
+    def test_recursive_search_max_filesize_and_read_errors(self):
+        dir_name = "test_filesize_search"
+        os.makedirs(dir_name, exist_ok=True)
+        with open(os.path.join(dir_name, 'big.txt'), 'w') as f:
+            f.write('test\n' * 1000)
+        with open(os.path.join(dir_name, 'latin1.txt'), 'wb') as f:
+            f.write(b'caf\xe9 test\n')
+        with open(os.path.join(dir_name, 'small.txt'), 'w') as f:
+            f.write('a small test\n')
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r', '--max-filesize', '1K',
+                                 '--binary-files', 'text'], capture_output=True, text=True)
+        # bytes that are not valid UTF-8 are replaced instead of stopping the search of the file
+        self.assertEqual(sorted(result.stdout.splitlines()), [f"{dir_name}/latin1.txt: caf\ufffd test",
+                                                              f"{dir_name}/small.txt: a small test"])
+        self.assertEqual(result.stderr, "")
+        result = subprocess.run(['python', 'main.py', 'caf. test', dir_name, '-r', '--encoding', 'latin-1'],
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/latin1.txt: caf\xe9 test\n")
+        shutil.rmtree(dir_name)
+
+    def test_recursive_search_include_exclude(self):
+        dir_name = "test_glob_search"
+        os.makedirs(os.path.join(dir_name, 'node_modules'), exist_ok=True)
+        for name in ('main.py', 'notes.txt', os.path.join('node_modules', 'lib.py')):
+            with open(os.path.join(dir_name, name), 'w') as f:
+                f.write(f'test in {os.path.basename(name)}\n')
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r', '--include', '*.py', '--exclude-dir',
+                                 'node_modules'], capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/main.py: test in main.py\n")
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r', '--exclude', '*.py'],
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/notes.txt: test in notes.txt\n")
+        shutil.rmtree(dir_name)
+
+    def test_recursive_search_ignore_files(self):
+        dir_name = "test_ignore_search"
+        os.makedirs(os.path.join(dir_name, 'build'), exist_ok=True)
+        os.makedirs(os.path.join(dir_name, '.git'), exist_ok=True)
+        for name in ('app.log', 'keep.log', os.path.join('build', 'out.txt'), os.path.join('.git', 'config')):
+            with open(os.path.join(dir_name, name), 'w') as f:
+                f.write(f'test in {os.path.basename(name)}\n')
+        with open(os.path.join(dir_name, '.gitignore'), 'w') as f:
+            f.write('build/\n*.log\n!keep.log\n')
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r', '--ignore-files'],
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/keep.log: test in keep.log\n")
+        shutil.rmtree(dir_name)
+
+    def test_recursive_search_with_index(self):
+        dir_name = "test_index_search"
+        os.makedirs(dir_name, exist_ok=True)
+        with open(os.path.join(dir_name, 'a.txt'), 'w') as f:
+            f.write('request id 4711 handled\n')
+        with open(os.path.join(dir_name, 'b.txt'), 'w') as f:
+            f.write('request id 4712 handled\n')
+        result = subprocess.run(['python', 'main.py', 'index', dir_name], capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"Indexed 2 files in '{dir_name}', 2 updated and 0 removed.\n")
+        result = subprocess.run(['python', 'main.py', 'id 4711', dir_name, '-r', '--index'], capture_output=True,
+                                text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/a.txt: request id 4711 handled\n")
+
+        # files changed after indexing are still searched
+        with open(os.path.join(dir_name, 'b.txt'), 'a') as f:
+            f.write('request id 4711 retried\n')
+        result = subprocess.run(['python', 'main.py', 'id 4711', dir_name, '-r', '--index', '-C'],
+                                capture_output=True, text=True)
+        self.assertEqual(sorted(result.stdout.splitlines()), [f"{dir_name}/a.txt: 1", f"{dir_name}/b.txt: 1"])
+        result = subprocess.run(['python', 'main.py', 'index', dir_name], capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"Indexed 2 files in '{dir_name}', 1 updated and 0 removed.\n")
+
+        # escapes and verbose patterns do not require the text they are written as
+        for pattern in (r'id\x204711', r'id\0404711', '(?x)id \\ 4711'):
+            result = subprocess.run(['python', 'main.py', pattern, dir_name, '-r', '--index', '-l'],
+                                    capture_output=True, text=True)
+            self.assertEqual(sorted(result.stdout.splitlines()), [f"{dir_name}/a.txt", f"{dir_name}/b.txt"])
+
+        # the indexed bytes only tell about encodings that store ASCII text as ASCII bytes
+        with open(os.path.join(dir_name, 'c.txt'), 'wb') as f:
+            f.write('request id 4713 handled\n'.encode('utf-16'))
+        subprocess.run(['python', 'main.py', 'index', dir_name], capture_output=True, text=True)
+        result = subprocess.run(['python', 'main.py', 'id 4713', dir_name, '-r', '--index', '-l', '--encoding',
+                                 'utf-16'], capture_output=True, text=True)
+        self.assertEqual((result.stdout, result.returncode), (f"{dir_name}/c.txt\n", 0))
+        os.remove(os.path.join(dir_name, 'c.txt'))
+
+        # only the index itself is left out of the search, not files with a similar name
+        with open(os.path.join(dir_name, '.grepindex.notes'), 'w') as f:
+            f.write('request id 4711 noted\n')
+        result = subprocess.run(['python', 'main.py', 'noted', dir_name, '-r'], capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/.grepindex.notes: request id 4711 noted\n")
+        shutil.rmtree(dir_name)
+
+    def test_recursive_search_list_files(self):
+        dir_name = "test_list_files"
+        os.makedirs(os.path.join(dir_name, 'sub'), exist_ok=True)
+        with open(os.path.join(dir_name, 'a.txt'), 'w') as f:
+            f.write('test one\ntest two\n')
+        with open(os.path.join(dir_name, 'sub', 'b.txt'), 'w') as f:
+            f.write('nothing here\n')
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r', '-l'], capture_output=True, text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/a.txt\n")
+        result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r', '-L', '-j', '2'], capture_output=True,
+                                text=True)
+        self.assertEqual(result.stdout, f"{dir_name}/sub/b.txt\n")
+        result = subprocess.run(['python', 'main.py', 'missing', dir_name, '-r', '-l'], capture_output=True,
+                                text=True)
+        self.assertEqual((result.stdout, result.returncode), ("", 1))
+        shutil.rmtree(dir_name)
+
+    def test_search_compressed(self):
+        dir_name = "test_compressed_search"
+        os.makedirs(dir_name, exist_ok=True)
+        content = b'first line\nthe needle line\nlast line\n'
+        for name, module in (('a.log.gz', gzip), ('b.log.bz2', bz2), ('c.log.xz', lzma)):
+            with open(os.path.join(dir_name, name), 'wb') as f:
+                f.write(module.compress(content))
+        with open(os.path.join(dir_name, 'cut.gz'), 'wb') as f:
+            f.write(gzip.compress(content * 1000)[:100])
+        result = subprocess.run(['python', 'main.py', 'needle', dir_name, '-r', '-z', '-j', '2'], capture_output=True,
+                                text=True)
+        self.assertEqual(sorted(result.stdout.splitlines()), [f"{dir_name}/a.log.gz: the needle line",
+                                                              f"{dir_name}/b.log.bz2: the needle line",
+                                                              f"{dir_name}/c.log.xz: the needle line"])
+        self.assertIn(f"Error reading file '{dir_name}/cut.gz'", result.stderr)
+        result = subprocess.run(['python', 'main.py', 'needle', os.path.join(dir_name, 'c.log.xz'), '-z', '-A', '1'],
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout, "first line\nthe needle line\nI found 'needle' in the file.\n")
+        result = subprocess.run(['python', 'main.py', 'needle', '-z'], capture_output=True,
+                                input=gzip.compress(content))
+        self.assertEqual(result.stdout, b"the needle line\nI found 'needle' in the file.\n")
+        result = subprocess.run(['python', 'main.py', 'needle', os.path.join(dir_name, 'a.log.gz')],
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout, "")
+        shutil.rmtree(dir_name)
+
+    def test_stats_and_profile(self):
+        if not os.path.exists('test_recursive_search'):
+            create_dir_for_recursive_test('test_recursive_search')
+        for jobs in ('1', '2'):
+            result = subprocess.run(['python', 'main.py', 'test', 'test_recursive_search', '-r', '-j', jobs,
+                                     '--exclude', 'file3.txt', '--stats'], capture_output=True, text=True)
+            self.assertEqual(len(result.stdout.splitlines()), 2)
+            report = result.stderr.splitlines()
+            self.assertEqual(report[:4], ["files: 3 walked, 1 skipped, 2 searched", "bytes read: 67",
+                                          "lines scanned: 2", "matches: 2"])
+            self.assertTrue(report[4].startswith("time: walk "))
+            self.assertTrue(report[5].startswith("total time: "))
+        # the counters come from the search itself, it stops after the first match and reads the decompressed bytes
+        with open('test.txt', 'rb') as file, gzip.open('test_stats.txt.gz', 'wb') as compressed:
+            compressed.write(file.read())
+        for args, counts in ((['test.txt', '-m', '1'], ["bytes read: 100", "lines scanned: 4"]),
+                             (['test.txt', '-l'], ["bytes read: 100", "lines scanned: 4"]),
+                             (['test.txt'], ["bytes read: 317", "lines scanned: 10"]),
+                             (['test_stats.txt.gz', '-z'], ["bytes read: 317", "lines scanned: 10"])):
+            result = subprocess.run(['python', 'main.py', 'second'] + args + ['--stats'], capture_output=True,
+                                    text=True)
+            self.assertEqual(result.stderr.splitlines()[1:3], counts)
+        os.remove('test_stats.txt.gz')
+        profile = "test_profile.out"
+        result = subprocess.run(['python', 'main.py', 'second', 'test.txt', '-A', '1', '--stats', '--profile',
+                                 profile], capture_output=True, text=True)
+        self.assertEqual(result.stdout, "This is the first line.\nThis is the second line.\n"
+                                        "I found 'second' in the file.\n")
+        self.assertIn("matches: 1", result.stderr)
+        self.assertTrue(os.path.getsize(profile) > 0)
+        os.remove(profile)
+
+    def test_bench(self):
+        result = subprocess.run(['python', 'main.py', 'bench', '--size', '32K', '--repeat', '1', '--corpus',
+                                 'deep-tree', '--match-rate', 'dense', '--target', 'search_files_recursive',
+                                 '--pattern', 'literal', '--pattern', 'context'], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0)
+        report = json.loads(result.stdout)
+        self.assertEqual([(run['corpus'], run['pattern']) for run in report['results']],
+                         [('deep-tree', 'literal'), ('deep-tree', 'context')])
+        literal = report['results'][0]
+        self.assertEqual(literal['files'], 8)
+        self.assertGreater(literal['output_lines'], 0)
+        for key in ('wall_time', 'lines_per_second', 'mb_per_second', 'peak_rss_kb'):
+            self.assertIn(key, literal)
+
+    def test_match_api_and_server(self):
+        matches = list(main.iter_matches('second', 'test.txt', case_insensitive=True))
+        self.assertEqual([(match.line_number, match.offset, match.line, match.spans) for match in matches],
+                         [(4, 75, "This is the second line.", [(12, 18)]),
+                          (10, 271, "THIS IS SECOND TEST LINE for case-insensitive.", [(8, 14)])])
+        create_dir_for_recursive_test('test_recursive_search')
+        matches = list(main.iter_matches(['This', 'One'], 'test_recursive_search', recursive=True, max_count=1))
+        self.assertEqual(sorted((os.path.relpath(match.path, 'test_recursive_search'), match.spans)
+                                for match in matches),
+                         [('file1.txt', [(0, 4)]), (os.path.join('subdir', 'file2.txt'), [(0, 3)]),
+                          (os.path.join('subdir', 'file3.txt'), [(0, 4)])])
+        with self.assertRaises(FileNotFoundError):
+            list(main.iter_matches('test', 'missing.txt'))
+
+        socket_path = 'test_server.sock'
+        server = subprocess.Popen(['python', 'main.py', 'serve', socket_path], stderr=subprocess.PIPE, text=True)
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.05)
+            result = subprocess.run(['python', 'main.py', 'serve', socket_path], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 1)
+            self.assertEqual(result.stderr, f"A server is already listening on '{socket_path}'.\n")
+            for _ in range(2):
+                served = list(main.query_server(socket_path, 'test', 'test_recursive_search', recursive=True,
+                                                exclude=['file3.txt']))
+                self.assertEqual(sorted(match.line for match in served),
+                                 ["One can test a program by running test cases.", "This is a test file."])
+            with self.assertRaises(RuntimeError):
+                list(main.query_server(socket_path, '(', 'test.txt'))
+            # a compressed file that is cut short is reported after the matches found before the cut
+            truncated = 'test_truncated.gz'
+            data = gzip.compress(b''.join(b'test line %d\n' % number for number in range(100000)))
+            with open(truncated, 'wb') as f:
+                f.write(data[:len(data) // 2])
+            served = []
+            with self.assertRaisesRegex(RuntimeError, 'EOFError'):
+                for match in main.query_server(socket_path, 'test', truncated, search_compressed=True):
+                    served.append(match)
+            os.remove(truncated)
+            self.assertGreater(len(served), 0)
+        finally:
+            server.terminate()
+            server.communicate(timeout=10)
+        self.assertEqual(server.returncode, 0)
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_follow(self):
+        log = 'test_follow.log'
+        with open(log, 'w') as f:
+            f.write('old error\nok\n')
+        process = subprocess.Popen(['python', 'main.py', 'error', log, '--follow', '-B', '1'], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True)
+        # the follow search never ends by itself, it is stopped if the test hangs
+        watchdog = threading.Timer(30, process.kill)
+        watchdog.start()
+        try:
+            self.assertEqual(process.stdout.readline(), "old error\n")
+            self.assertEqual(process.stdout.readline(), "ok\n")
+            with open(log, 'a') as f:
+                f.write('new ')
+                f.flush()
+                time.sleep(0.3)
+                # only whole lines are searched
+                f.write('error\nafter\nskipped\n')
+            self.assertEqual(process.stdout.readline(), "new error\n")
+            self.assertEqual(process.stdout.readline(), "after\n")
+            # rotated: the rest of the old file is searched and then the new file from its start
+            os.rename(log, log + '.1')
+            with open(log + '.1', 'a') as f:
+                f.write('last error of the old file\n')
+            with open(log, 'w') as f:
+                f.write('rotated error\n')
+            self.assertEqual(process.stdout.readline(), "--\n")
+            self.assertEqual(process.stdout.readline(), "last error of the old file\n")
+            self.assertEqual(process.stdout.readline(), "rotated error\n")
+            # truncated: the file, now shorter than what was read, is searched again from its start
+            with open(log, 'w') as f:
+                f.write('error 2\n')
+            self.assertEqual(process.stdout.readline(), "error 2\n")
+            process.send_signal(signal.SIGINT)
+            _, stderr = process.communicate(timeout=10)
+        finally:
+            watchdog.cancel()
+            for filename in (log, log + '.1'):
+                if os.path.exists(filename):
+                    os.remove(filename)
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(stderr, f"File '{log}' was replaced, following the new file.\n"
+                                 f"File '{log}' was truncated, searching it from the start.\n")
+
+        # anchors match at the ends of every line, the search ends by itself at the max count
+        with open(log, 'w') as f:
+            f.write('a\n\nb\n')
+        result = subprocess.run(['python', 'main.py', '^$', log, '--follow', '-m', '1'], capture_output=True,
+                                text=True, timeout=30)
+        os.remove(log)
+        self.assertEqual(result.stdout, "\n")
+
+        result = subprocess.run(['python', 'main.py', 'error', '--follow'], capture_output=True, text=True)
+        self.assertIn("argument --follow: a file or a directory to follow is required", result.stderr)
+        result = subprocess.run(['python', 'main.py', 'error', 'test.txt', '--follow', '-C'], capture_output=True,
+                                text=True)
+        self.assertIn("argument --follow: not allowed with argument -C/--count_only", result.stderr)
+
+    def test_interrupt(self):
+        # without --follow Ctrl-C ends the search with 130, the lines found until then are written
+        process = subprocess.Popen(['python', 'main.py', 'error', '--line-buffered'], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        try:
+            process.stdin.write('an error\nok\n')
+            process.stdin.flush()
+            self.assertEqual(process.stdout.readline(), "an error\n")
+            process.send_signal(signal.SIGINT)
+            _, stderr = process.communicate(timeout=10)
+        finally:
+            if process.poll() is None:
+                process.kill()
+        self.assertEqual(process.returncode, 130)
+        self.assertEqual(stderr, "")
     def test_recursive_search_directory_not_found(self):
         dir_name = "non_existing_directory"
         result = subprocess.run(['python', 'main.py', 'test', dir_name, '-r'], capture_output=True, text=True)